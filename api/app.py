@@ -4,22 +4,47 @@
 """
 from __future__ import annotations
 import os
+import asyncio
+import anyio
 import json
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date
 from typing import Optional, Tuple
 from urllib.parse import quote_plus
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import psycopg2
-from psycopg2 import sql
-from psycopg2.pool import SimpleConnectionPool
+from starlette.background import BackgroundTask
+from psycopg import AsyncClientCursor, sql
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+from psycopg.errors import UndefinedTable
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
 from dotenv import load_dotenv
 from fastapi.responses import RedirectResponse
 
+from utils.data_version import BASE_TABLE_SQL, get_data_version_async
+from utils.fields import VALUE_FIELDS
+from utils.stats import stats_table_name
+
 load_dotenv()
 
 DEFAULT_MIN_POOL = 1
 DEFAULT_MAX_POOL = 10
+DEFAULT_POOL_TIMEOUT = 10.0
+DEFAULT_POOL_MAX_WAITING = 100
+STREAM_FETCH_SIZE = int(os.getenv("API_STREAM_FETCH_SIZE", 2000))
+TILE_CACHE_MB = float(os.getenv("API_TILE_CACHE_MB", 64))
+RESPONSE_CACHE_MB = float(os.getenv("API_RESPONSE_CACHE_MB", 128))
+DATA_VERSION_TTL = float(os.getenv("API_DATA_VERSION_TTL", 5))
+MAX_TILE_ZOOM = 22
+CLUSTER_CELLS_PER_TILE = int(os.getenv("API_CLUSTER_CELLS_PER_TILE", 4))
+EXPORT_DIR = os.getenv("API_EXPORT_DIR", os.path.join("results", "exports"))
+OGR2OGR = os.getenv("OGR2OGR", "ogr2ogr")
 APP_PORT = int(os.getenv("API_PORT", 8080))
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -46,12 +71,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-pool: Optional[SimpleConnectionPool] = None
+pool: Optional[AsyncConnectionPool] = None
 TABLE_NAME = os.getenv("API_TABLE", "my_features")
 
 
 def get_conn_params():
-    """Return a dict of connection params for psycopg2.connect"""
+    """Return a dict of connection params for psycopg.connect"""
     if DATABASE_URL:
         return {"dsn": DATABASE_URL}
     if PGHOST and PGDATABASE and PGUSER and PGPASSWORD:
@@ -60,48 +85,92 @@ def get_conn_params():
 
 
 @app.on_event("startup")
-def startup():
+async def startup():
     global pool
-    try:
-        params = get_conn_params()
-    except RuntimeError as e:
-        raise RuntimeError(str(e))
-    minconn = int(os.getenv("PG_POOL_MIN", DEFAULT_MIN_POOL))
-    maxconn = int(os.getenv("PG_POOL_MAX", DEFAULT_MAX_POOL))
-    if "dsn" in params:
-        pool = SimpleConnectionPool(minconn, maxconn, dsn=params["dsn"])
-    else:
-        pool = SimpleConnectionPool(minconn, maxconn,
-                                    host=params["host"],
-                                    port=params["port"],
-                                    dbname=params["dbname"],
-                                    user=params["user"],
-                                    password=params["password"])
-    conn = pool.getconn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1;")
-    finally:
-        pool.putconn(conn)
+    params = get_conn_params()
+    conninfo = make_conninfo(params.pop("dsn", ""), **params)
+    # when all connections are busy, requests wait up to PG_POOL_TIMEOUT seconds for one
+    # (at most PG_POOL_MAX_WAITING of them) and then get a 503 instead of an error
+    pool = AsyncConnectionPool(
+        conninfo,
+        min_size=int(os.getenv("PG_POOL_MIN", DEFAULT_MIN_POOL)),
+        max_size=int(os.getenv("PG_POOL_MAX", DEFAULT_MAX_POOL)),
+        timeout=float(os.getenv("PG_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT)),
+        max_waiting=int(os.getenv("PG_POOL_MAX_WAITING", DEFAULT_POOL_MAX_WAITING)),
+        open=False,
+    )
+    await pool.open(wait=True)
+    async with pool.connection() as conn:
+        await conn.execute("SELECT 1;")
 
 
 @app.on_event("shutdown")
-def shutdown():
+async def shutdown():
     global pool
     if pool:
-        pool.closeall()
+        await pool.close()
+
+
+@app.exception_handler(PoolTimeout)
+@app.exception_handler(TooManyRequests)
+async def pool_exhausted(request: Request, exc: Exception):
+    return JSONResponse(status_code=503, content={"detail": "Database busy, retry later"}, headers={"Retry-After": "1"})
+
+class FilterError(ValueError):
+    """Invalid filter query parameter; answered with 400."""
+
+
+@app.exception_handler(FilterError)
+async def filter_error(request: Request, exc: FilterError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
 
 def parse_bbox(bbox_str: str) -> Tuple[float, float, float, float]:
     parts = bbox_str.split(",")
     if len(parts) != 4:
-        raise ValueError("bbox must be 'minx,miny,maxx,maxy'")
+        raise FilterError("bbox must be 'minx,miny,maxx,maxy'")
     try:
         return tuple(float(p) for p in parts)
     except Exception:
-        raise ValueError("bbox coordinates must be numbers")
+        raise FilterError("bbox coordinates must be numbers")
+
+
+def parse_values(values_str: str) -> int:
+    """'1,4,8' -> bitmask of the i_value_k categories (bit k-1)."""
+    mask = 0
+    for part in values_str.split(","):
+        try:
+            k = int(part)
+        except ValueError:
+            raise FilterError("values must be a comma-separated list of 1..10")
+        if not 1 <= k <= len(VALUE_FIELDS):
+            raise FilterError("values must be a comma-separated list of 1..10")
+        mask |= 1 << (k - 1)
+    return mask
+
+
+def parse_date(value: str) -> str:
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise FilterError("dates must be YYYY-MM-DD")
+
 
+def matching_masks(mask: int, match_all: bool) -> list:
+    # i_mask has only 1024 possible values, so "has any/all of these bits" becomes an
+    # indexable i_mask = ANY(...) instead of a bitwise predicate on every row
+    full = 1 << len(VALUE_FIELDS)
+    if match_all:
+        return [m for m in range(full) if m & mask == mask]
+    return [m for m in range(full) if m & mask]
 
-def build_filters(bbox: Optional[str], region: Optional[str], date_from: Optional[str], date_to: Optional[str]):
+
+def decode_mask(mask: Optional[int]) -> list:
+    return [k + 1 for k in range(len(VALUE_FIELDS)) if mask and mask & (1 << k)]
+
+
+def build_filters(bbox: Optional[str], region: Optional[str], date_from: Optional[str], date_to: Optional[str],
+                  values: Optional[str] = None, values_match: str = "any"):
     """
     Returns tuple (where_clauses_list, params_list)
     """
@@ -111,112 +180,635 @@ def build_filters(bbox: Optional[str], region: Optional[str], date_from: Optiona
         where.append(sql.SQL("t_region ILIKE %s"))
         params.append(f"%{region}%")
     if date_from:
-        where.append(sql.SQL("d_date >= %s"))
-        params.append(date_from)
+        # typed as date so partitioned tables can prune partitions, also for prepared statements
+        where.append(sql.SQL("d_date >= %s::date"))
+        params.append(parse_date(date_from))
     if date_to:
-        where.append(sql.SQL("d_date <= %s"))
-        params.append(date_to)
+        where.append(sql.SQL("d_date <= %s::date"))
+        params.append(parse_date(date_to))
     if bbox:
         minx, miny, maxx, maxy = parse_bbox(bbox)
         where.append(sql.SQL("ST_Intersects(geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))"))
         params.extend([minx, miny, maxx, maxy])
+    if values:
+        where.append(sql.SQL("i_mask = ANY(%s::smallint[])"))
+        params.append(matching_masks(parse_values(values), values_match == "all"))
     return where, params
 
 
+def filter_key(bbox: Optional[str], region: Optional[str], date_from: Optional[str], date_to: Optional[str],
+               values: Optional[str] = None, values_match: str = "any") -> tuple:
+    """
+    Cache / ETag key part for the build_filters arguments, on the parsed values:
+    values=4,1 and values=1,4 or bbox=30,50,.. and bbox=30.0,50.0,.. share one entry.
+    """
+    return (
+        parse_bbox(bbox) if bbox else None,
+        region or None,
+        parse_date(date_from) if date_from else None,
+        parse_date(date_to) if date_to else None,
+        tuple(matching_masks(parse_values(values), values_match == "all")) if values else None,
+    )
+
+
+class LRUCache:
+    """Thread-safe LRU of bytes values, bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+tile_cache = LRUCache(int(TILE_CACHE_MB * 1024 * 1024))
+response_cache = LRUCache(int(RESPONSE_CACHE_MB * 1024 * 1024))
+_data_version = {"value": None, "checked_at": 0.0}
+_data_version_lock = threading.Lock()
+
+
+async def current_data_version() -> int:
+    """
+    Data version of TABLE_NAME (bumped by the transform on every load), re-read at most
+    every DATA_VERSION_TTL seconds. Caches are cleared when it changes.
+    """
+    now = time.monotonic()
+    with _data_version_lock:
+        if _data_version["value"] is not None and now - _data_version["checked_at"] < DATA_VERSION_TTL:
+            return _data_version["value"]
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            version = await get_data_version_async(cur, TABLE_NAME)
+    with _data_version_lock:
+        if version != _data_version["value"]:
+            tile_cache.clear()
+            response_cache.clear()
+        _data_version["value"] = version
+        _data_version["checked_at"] = now
+    return version
+
+
+def etag_for(key: tuple) -> str:
+    """Strong ETag from a cache key; keys always start with the data version."""
+    return '"' + hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + '"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class StreamConnection:
+    """
+    A pooled connection owned by a streamed response. Once the body generator has started
+    only the generator returns it, in its finally after its cursor / COPY is closed: Starlette
+    runs the background task as soon as the client disconnects, while the paused generator
+    still holds the cursor. The background task only covers a body that never started.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.started = False
+        self.released = False
+
+    async def release(self):
+        if self.released:
+            return
+        self.released = True
+        # a body closed by a client disconnect runs inside the response's cancelled scope
+        with anyio.CancelScope(shield=True):
+            if self.conn.info.transaction_status in (TransactionStatus.INTRANS, TransactionStatus.INERROR):
+                try:
+                    await self.conn.rollback()
+                except Exception:
+                    pass
+            # the pool discards connections left mid-query
+            await pool.putconn(self.conn)
+
+    async def release_unstarted(self):
+        if not self.started:
+            await self.release()
+
+
+def cache_headers(etag: str) -> dict:
+    # clients keep the body but revalidate; a matching ETag costs no DB work
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
 # ручки
 
 @app.get("/")
-def root():
+async def root():
     return RedirectResponse(url="/docs")
 
 @app.get("/health",
          summary="Show service health.")
-def health_status():
+async def health_status():
     return {"status": "ok"}
 
 
+async def estimate_count(cur, where_sql, params) -> Optional[int]:
+    """
+    Cheap row count: pg_class.reltuples for the whole table, otherwise the planner's
+    row estimate for the filtered query. Returns None if no statistics are available.
+    """
+    if not params:
+        await cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", (TABLE_NAME,), prepare=True)
+        row = await cur.fetchone()
+        if row and row[0] is not None and row[0] >= 0:
+            return int(row[0])
+    q = sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 FROM {tbl} {where}").format(tbl=sql.Identifier(TABLE_NAME), where=where_sql)
+    await cur.execute(q, params)
+    plan = (await cur.fetchone())[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 @app.get("/features.geojson",
-         response_class=JSONResponse,
+         response_class=StreamingResponse,
          summary="Get features by params.")
-def features_geojson(
+async def features_geojson(
+    request: Request,
     bbox: Optional[str] = Query(None, description="bbox=minx,miny,maxx,maxy"),
     region: Optional[str] = Query(None),
     date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
     date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    values: Optional[str] = Query(None, description="values=1,4,8: features with i_value_k > 0 for these k"),
+    values_match: str = Query("any", pattern="^(any|all)$", description="Match any or all of `values`"),
     limit: int = Query(1000, ge=1, le=10000),
-    offset: int = Query(0, ge=0),
+    offset: int = Query(0, ge=0, description="Legacy paging; prefer after_id"),
+    after_id: Optional[int] = Query(None, ge=0, description="Keyset cursor: return features with id > after_id (meta.next)"),
+    count: str = Query("estimate", pattern="^(exact|estimate|none)$",
+                       description="meta.total: exact COUNT(*), planner estimate, or none"),
 ):
     global pool
     if pool is None:
         raise HTTPException(status_code=500, detail="DB pool not initialized")
 
-    where_clauses, params = build_filters(bbox, region, date_from, date_to)
-    where_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(where_clauses) if where_clauses else sql.SQL("")
-    q = sql.SQL("SELECT id, d_date, t_region, t_city, long, lat, ST_AsGeoJSON(geom) AS geom_json FROM {tbl} {where} ORDER BY id LIMIT %s OFFSET %s").format(
-        tbl=sql.Identifier(TABLE_NAME),
-        where=where_sql
-    )
-    params_with_paging = params + [limit, offset]
+    where_clauses, params = build_filters(bbox, region, date_from, date_to, values, values_match)
+    if after_id is not None:
+        offset = 0
+    key = ("features", await current_data_version(), filter_key(bbox, region, date_from, date_to, values, values_match),
+           limit, offset, after_id, count)
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    cached = response_cache.get(key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/geo+json", headers=cache_headers(etag))
 
-    conn = pool.getconn()
-    try:
-        cur = conn.cursor()
-        cur.execute(q, params_with_paging)
-        rows = cur.fetchall()
-        features = []
-        for row in rows:
-            fid, d_date, region_v, city, lon, lat, geom_json = row
-            geom = json.loads(geom_json) if geom_json else None
-            props = {
-                "id": fid,
-                "d_date": d_date.isoformat() if getattr(d_date, "isoformat", None) else d_date,
-                "t_region": region_v,
-                "t_city": city,
-                "long": lon,
-                "lat": lat,
-            }
-            features.append({"type": "Feature", "geometry": geom, "properties": props})
-        total = None
-        if offset == 0:
-            count_q = sql.SQL("SELECT COUNT(*) FROM {tbl} {where}").format(tbl=sql.Identifier(TABLE_NAME), where=where_sql)
-            cur.execute(count_q, params)
-            total = cur.fetchone()[0]
-        cur.close()
-    finally:
-        pool.putconn(conn)
-
-    result = {"type": "FeatureCollection", "features": features, "meta": {"limit": limit, "offset": offset, "total": total}}
-    return JSONResponse(content=result)
+    filter_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(where_clauses) if where_clauses else sql.SQL("")
+    page_clauses = list(where_clauses)
+    page_params = list(params)
+    if after_id is not None:
+        page_clauses.append(sql.SQL("id > %s"))
+        page_params.append(after_id)
+    where_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(page_clauses) if page_clauses else sql.SQL("")
+    # Postgres renders each Feature as JSON text; Python only concatenates.
+    q = sql.SQL("""
+        SELECT id, json_build_object(
+            'type', 'Feature',
+            'geometry', ST_AsGeoJSON(geom)::json,
+            'properties', json_build_object('id', id, 'd_date', d_date, 't_region', t_region,
+                                            't_city', t_city, 'long', long, 'lat', lat,
+                                            'values', ARRAY(SELECT k FROM generate_series(1, 10) AS k
+                                                            WHERE i_mask & (1 << (k - 1)) <> 0))
+        )::text
+        FROM {tbl} {where} ORDER BY id LIMIT %s OFFSET %s
+    """).format(tbl=sql.Identifier(TABLE_NAME), where=where_sql)
+    params_with_paging = page_params + [limit, offset]
+
+    # borrowed before the response starts, so an exhausted pool still gets the 503 handler
+    borrowed = StreamConnection(await pool.getconn())
+    conn = borrowed.conn
+
+    async def body():
+        borrowed.started = True
+        n = 0
+        last_id = None
+        chunks = []
+        try:
+            chunks.append(b'{"type":"FeatureCollection","features":[')
+            yield chunks[-1]
+            async with conn.cursor(name=f"features_geojson_{uuid.uuid4().hex}") as cur:
+                await cur.execute(q, params_with_paging)
+                while True:
+                    rows = await cur.fetchmany(STREAM_FETCH_SIZE)
+                    if not rows:
+                        break
+                    parts = [("," if n or i else "") + feature for i, (_, feature) in enumerate(rows)]
+                    n += len(rows)
+                    last_id = rows[-1][0]
+                    chunks.append("".join(parts).encode("utf-8"))
+                    yield chunks[-1]
+            total = None
+            async with conn.cursor() as cur:
+                if count == "exact":
+                    count_q = sql.SQL("SELECT COUNT(*) FROM {tbl} {where}").format(tbl=sql.Identifier(TABLE_NAME), where=filter_sql)
+                    await cur.execute(count_q, params, prepare=True)
+                    total = (await cur.fetchone())[0]
+                elif count == "estimate":
+                    total = await estimate_count(cur, filter_sql, params)
+            meta = {"limit": limit, "offset": offset, "after_id": after_id,
+                    "next": last_id if n == limit else None,
+                    "total": total, "total_is_estimate": count == "estimate"}
+            chunks.append(('],"meta":' + json.dumps(meta) + "}").encode("utf-8"))
+            yield chunks[-1]
+        finally:
+            await borrowed.release()
+        response_cache.put(key, b"".join(chunks))
+
+    return StreamingResponse(body(), media_type="application/geo+json", headers=cache_headers(etag),
+                             background=BackgroundTask(borrowed.release_unstarted))
 
 
 @app.get("/feature/{fid}",
          response_class=JSONResponse,
          summary="Get features by ID.")
-def get_feature(fid: int):
+async def get_feature(request: Request, fid: int):
     global pool
     if pool is None:
         raise HTTPException(status_code=500, detail="DB pool not initialized")
-    conn = pool.getconn()
-    try:
-        cur = conn.cursor()
-        q = sql.SQL("SELECT id, d_date, t_region, t_city, long, lat, ST_AsGeoJSON(geom) FROM {tbl} WHERE id = %s").format(tbl=sql.Identifier(TABLE_NAME))
-        cur.execute(q, (fid,))
-        row = cur.fetchone()
-        cur.close()
-    finally:
-        pool.putconn(conn)
+    etag = etag_for(("feature", await current_data_version(), fid))
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    async with pool.connection() as conn:
+        q = sql.SQL("SELECT id, d_date, t_region, t_city, long, lat, ST_AsGeoJSON(geom), i_mask FROM {tbl} WHERE id = %s").format(tbl=sql.Identifier(TABLE_NAME))
+        cur = await conn.execute(q, (fid,), prepare=True)
+        row = await cur.fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="Feature not found")
-    fid, d_date, region_v, city, lon, lat, geom_json = row
+    fid, d_date, region_v, city, lon, lat, geom_json, i_mask = row
     geom = json.loads(geom_json) if geom_json else None
     props = {"id": fid, "d_date": d_date.isoformat() if getattr(d_date, "isoformat", None) else d_date,
-             "t_region": region_v, "t_city": city, "long": lon, "lat": lat}
-    return JSONResponse({"type": "Feature", "geometry": geom, "properties": props})
+             "t_region": region_v, "t_city": city, "long": lon, "lat": lat, "values": decode_mask(i_mask)}
+    return JSONResponse({"type": "Feature", "geometry": geom, "properties": props}, headers=cache_headers(etag))
+
+
+@app.get("/tiles/{z}/{x}/{y}.pbf",
+         response_class=Response,
+         summary="Get Mapbox Vector Tile.")
+async def vector_tile(
+    request: Request,
+    z: int,
+    x: int,
+    y: int,
+    region: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    values: Optional[str] = Query(None, description="values=1,4,8: features with i_value_k > 0 for these k"),
+    values_match: str = Query("any", pattern="^(any|all)$", description="Match any or all of `values`"),
+):
+    global pool
+    if pool is None:
+        raise HTTPException(status_code=500, detail="DB pool not initialized")
+    if not (0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile coordinates out of range")
+
+    key = ("tile", await current_data_version(), z, x, y, filter_key(None, region, date_from, date_to, values, values_match))
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    tile = tile_cache.get(key)
+    if tile is None:
+        where_clauses, params = build_filters(None, region, date_from, date_to, values, values_match)
+        where_clauses.insert(0, sql.SQL("geom && ST_Transform(ST_TileEnvelope(%s, %s, %s, margin => %s), 4326)"))
+        params = [z, x, y, 64 / 4096] + params
+        q = sql.SQL("""
+            SELECT ST_AsMVT(mvt.*, %s, 4096, 'geom', 'id') FROM (
+                SELECT id, d_date::text AS d_date, t_region, t_city, i_mask, {values},
+                       ST_AsMVTGeom(ST_Transform(geom, 3857), ST_TileEnvelope(%s, %s, %s), 4096, 64, true) AS geom
+                FROM {tbl}
+                WHERE {where}
+            ) AS mvt
+        """).format(
+            tbl=sql.Identifier(TABLE_NAME),
+            values=sql.SQL(", ").join(sql.Identifier(c) for c in VALUE_FIELDS),
+            where=sql.SQL(" AND ").join(where_clauses),
+        )
+        async with pool.connection() as conn:
+            cur = await conn.execute(q, [TABLE_NAME, z, x, y] + params, prepare=True)
+            tile = bytes((await cur.fetchone())[0] or b"")
+        tile_cache.put(key, tile)
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=cache_headers(etag))
+
+
+@app.get("/clusters",
+         response_class=Response,
+         summary="Get point clusters (grid cells) for zoomed-out views.")
+async def clusters(
+    request: Request,
+    zoom: int = Query(..., ge=0, le=MAX_TILE_ZOOM, description="Map zoom level; sets the grid cell size"),
+    bbox: Optional[str] = Query(None, description="bbox=minx,miny,maxx,maxy"),
+    region: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    values: Optional[str] = Query(None, description="values=1,4,8: features with i_value_k > 0 for these k"),
+    values_match: str = Query("any", pattern="^(any|all)$", description="Match any or all of `values`"),
+):
+    """
+    Points snapped to a lon/lat grid of 360 / (2^zoom * CLUSTER_CELLS_PER_TILE) degrees.
+    One Feature per non-empty cell, placed at the mean position of its points, with
+    the point count and per-i_value_k sums.
+    """
+    global pool
+    if pool is None:
+        raise HTTPException(status_code=500, detail="DB pool not initialized")
+    where_clauses, params = build_filters(bbox, region, date_from, date_to, values, values_match)
+    key = ("clusters", await current_data_version(), zoom, filter_key(bbox, region, date_from, date_to, values, values_match))
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    body = response_cache.get(key)
+    if body is None:
+        cell = 360.0 / (2 ** zoom * CLUSTER_CELLS_PER_TILE)
+        where_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(where_clauses) if where_clauses else sql.SQL("")
+        q = sql.SQL("""
+            WITH cells AS (
+                SELECT count(*) AS n, avg(long) AS lon, avg(lat) AS lat, {sums}
+                FROM {tbl} {where}
+                GROUP BY floor(long / %s), floor(lat / %s)
+            )
+            SELECT json_build_object(
+                'type', 'FeatureCollection',
+                'features', COALESCE(json_agg(json_build_object(
+                    'type', 'Feature',
+                    'geometry', json_build_object('type', 'Point', 'coordinates', json_build_array(lon, lat)),
+                    'properties', json_build_object('count', n, {props})
+                )), '[]'::json),
+                'meta', json_build_object('zoom', %s::int, 'cell_size', %s::float8)
+            )::text
+            FROM cells
+        """).format(
+            tbl=sql.Identifier(TABLE_NAME),
+            where=where_sql,
+            sums=sql.SQL(", ").join(sql.SQL("sum({c}) AS {c}").format(c=sql.Identifier(c)) for c in VALUE_FIELDS),
+            props=sql.SQL(", ").join(sql.SQL("{name}, {c}").format(name=sql.Literal(c), c=sql.Identifier(c)) for c in VALUE_FIELDS),
+        )
+        async with pool.connection() as conn:
+            cur = await conn.execute(q, params + [cell, cell, zoom, cell], prepare=True)
+            body = (await cur.fetchone())[0].encode("utf-8")
+        response_cache.put(key, body)
+    return Response(content=body, media_type="application/geo+json", headers=cache_headers(etag))
+
+
+STATS_GROUPS = {
+    "region": sql.SQL("t_region"),
+    "city": sql.SQL("t_city"),
+    "date": sql.SQL("d_date"),
+    "month": sql.SQL("date_trunc('month', d_date)::date"),
+    "year": sql.SQL("extract(year FROM d_date)::int"),
+}
+
+
+def parse_group_by(group_by: Optional[str]) -> list:
+    groups = [g.strip() for g in group_by.split(",") if g.strip()] if group_by else []
+    for g in groups:
+        if g not in STATS_GROUPS:
+            raise FilterError(f"group_by must be a comma-separated list of {', '.join(STATS_GROUPS)}")
+    return list(dict.fromkeys(groups))
+
+
+@app.get("/stats",
+         response_class=Response,
+         summary="Feature counts and i_value_k sums grouped by region / city / period.")
+async def stats(
+    request: Request,
+    group_by: Optional[str] = Query(None, description="group_by=region,date (region, city, date, month, year)"),
+    region: Optional[str] = Query(None),
+    city: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+):
+    """
+    Answered from {table}_daily_stats, the region/city/day summary the transform rebuilds
+    with every load, so the cost depends on the number of groups, not of features.
+    """
+    global pool
+    if pool is None:
+        raise HTTPException(status_code=500, detail="DB pool not initialized")
+    groups = parse_group_by(group_by)
+    where_clauses, params = build_filters(None, region, date_from, date_to)
+    if city:
+        where_clauses.append(sql.SQL("t_city ILIKE %s"))
+        params.append(f"%{city}%")
+    key = ("stats", await current_data_version(), tuple(groups), filter_key(None, region, date_from, date_to), city or None)
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    body = response_cache.get(key)
+    if body is None:
+        group_cols = [sql.SQL("{expr} AS {name}").format(expr=STATS_GROUPS[g], name=sql.Identifier(g)) for g in groups]
+        where_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(where_clauses) if where_clauses else sql.SQL("")
+        group_sql = sql.SQL("GROUP BY {g} ORDER BY {g}").format(
+            g=sql.SQL(", ").join(sql.Identifier(g) for g in groups)) if groups else sql.SQL("")
+        async with pool.connection() as conn:
+            # API_TABLE may be the {table}_points view of a weighted table; the summary belongs to the table
+            cur = await conn.execute(BASE_TABLE_SQL, (TABLE_NAME, TABLE_NAME), prepare=True)
+            base_table = (await cur.fetchone())[0]
+            q = sql.SQL("""
+                SELECT json_build_object('group_by', %s::text[], 'rows', COALESCE(json_agg(row_to_json(s)), '[]'::json))::text
+                FROM (
+                    SELECT {cols}COALESCE(SUM(features), 0)::bigint AS features, {sums}
+                    FROM {tbl} {where} {group}
+                ) s
+            """).format(
+                cols=sql.SQL("").join(c + sql.SQL(", ") for c in group_cols),
+                sums=sql.SQL(", ").join(sql.SQL("COALESCE(SUM({c}), 0)::bigint AS {c}").format(c=sql.Identifier(c))
+                                        for c in VALUE_FIELDS),
+                tbl=sql.Identifier(stats_table_name(base_table)),
+                where=where_sql,
+                group=group_sql,
+            )
+            try:
+                cur = await conn.execute(q, [groups] + params, prepare=True)
+            except UndefinedTable:
+                raise HTTPException(status_code=404, detail="Summary table not found; run the transform first")
+            body = (await cur.fetchone())[0].encode("utf-8")
+        response_cache.put(key, body)
+    return Response(content=body, media_type="application/json", headers=cache_headers(etag))
+
+
+EXPORT_FORMATS = {
+    # ogr2ogr drivers write the file from a SQL query; FlatGeobuf gets its packed R-tree
+    # so clients can read a bbox from the cached file with HTTP range requests
+    "gpkg": {"driver": "GPKG", "media_type": "application/geopackage+sqlite3", "lco": []},
+    "fgb": {"driver": "FlatGeobuf", "media_type": "application/flatgeobuf", "lco": ["SPATIAL_INDEX=YES"]},
+    "csv": {"driver": None, "media_type": "text/csv", "lco": []},
+}
+_export_locks: dict = {}
+
+
+def export_query(where_clauses: list, csv: bool) -> sql.Composed:
+    where_sql = sql.SQL("WHERE ") + sql.SQL(" AND ").join(where_clauses) if where_clauses else sql.SQL("")
+    return sql.SQL("SELECT id, d_date, t_region, t_city, long, lat, {values}, {geom} FROM {tbl} {where} ORDER BY id").format(
+        values=sql.SQL(", ").join(sql.Identifier(c) for c in VALUE_FIELDS),
+        geom=sql.SQL("ST_AsText(geom) AS wkt" if csv else "geom"),
+        tbl=sql.Identifier(TABLE_NAME),
+        where=where_sql,
+    )
+
+
+def export_path(version: int, etag: str, fmt: str) -> str:
+    digest = etag.strip('"')[:16]
+    return os.path.join(EXPORT_DIR, f"{TABLE_NAME}_v{version}_{digest}.{fmt}")
+
+
+def prune_exports(version: int):
+    # files from older data versions can never be served again
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    current = f"{TABLE_NAME}_v{version}_"
+    for name in os.listdir(EXPORT_DIR):
+        if name.startswith(f"{TABLE_NAME}_v") and not name.startswith(current):
+            try:
+                os.remove(os.path.join(EXPORT_DIR, name))
+            except OSError:
+                pass
+
+
+async def run_ogr2ogr(fmt: str, query: str, path: str):
+    """Write the query result to path with ogr2ogr, via a temp file renamed into place."""
+    spec = EXPORT_FORMATS[fmt]
+    params = conninfo_to_dict(pool.conninfo)
+    env = dict(os.environ)
+    # the password goes through the environment, not the (visible) command line
+    password = params.pop("password", None)
+    if password:
+        env["PGPASSWORD"] = str(password)
+    tmp = f"{path}.{os.getpid()}.tmp.{fmt}"
+    args = [OGR2OGR, "-f", spec["driver"], tmp, "PG:" + make_conninfo(**params), "-sql", query, "-nln", TABLE_NAME]
+    for lco in spec["lco"]:
+        args += ["-lco", lco]
+    try:
+        proc = await asyncio.create_subprocess_exec(*args, env=env, stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise HTTPException(status_code=501, detail=f"{fmt} export needs ogr2ogr (GDAL) on the server")
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise HTTPException(status_code=500, detail=f"ogr2ogr failed: {stderr.decode(errors='replace')[-500:]}")
+    os.replace(tmp, path)
+
+
+def stream_csv(borrowed: StreamConnection, query: sql.Composed, params: list, path: Optional[str]):
+    """
+    COPY ... TO STDOUT on the borrowed connection streamed to the client; when path is given
+    the bytes are also saved there. The connection goes back to the pool once COPY is closed.
+    """
+    copy_q = sql.SQL("COPY ({q}) TO STDOUT WITH (FORMAT csv, HEADER)").format(q=query)
+
+    async def body():
+        borrowed.started = True
+        tmp = f"{path}.{os.getpid()}.tmp" if path else None
+        out = open(tmp, "wb") if tmp else None
+        done = False
+        try:
+            async with borrowed.conn.cursor() as cur:
+                async with cur.copy(copy_q, params) as copy:
+                    async for chunk in copy:
+                        data = bytes(chunk)
+                        if out:
+                            out.write(data)
+                        yield data
+            done = True
+        finally:
+            await borrowed.release()
+            if out:
+                out.close()
+                if done:
+                    os.replace(tmp, path)
+                else:
+                    os.remove(tmp)
+            if path:
+                _export_locks.pop(path, None)
+
+    return body()
+
+
+@app.get("/download/{fmt}", summary="Download features as GeoPackage, FlatGeobuf or CSV.")
+async def download(
+    request: Request,
+    fmt: str,
+    bbox: Optional[str] = Query(None, description="bbox=minx,miny,maxx,maxy"),
+    region: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    values: Optional[str] = Query(None, description="values=1,4,8: features with i_value_k > 0 for these k"),
+    values_match: str = Query("any", pattern="^(any|all)$", description="Match any or all of `values`"),
+):
+    global pool
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown format; use one of {', '.join(EXPORT_FORMATS)}")
+    if pool is None:
+        raise HTTPException(status_code=500, detail="DB pool not initialized")
+
+    where_clauses, params = build_filters(bbox, region, date_from, date_to, values, values_match)
+    version = await current_data_version()
+    key = ("download", version, fmt, filter_key(bbox, region, date_from, date_to, values, values_match))
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+
+    spec = EXPORT_FORMATS[fmt]
+    path = export_path(version, etag, fmt)
+    headers = cache_headers(etag)
+    filename = f"{TABLE_NAME}.{fmt}"
+    if os.path.exists(path):
+        # FileResponse answers Range requests, e.g. FlatGeobuf readers fetching the index first
+        return FileResponse(path, media_type=spec["media_type"], filename=filename, headers=headers)
 
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    prune_exports(version)
+    query = export_query(where_clauses, csv=spec["driver"] is None)
+    if spec["driver"] is None:
+        # stream straight from COPY; only one request per file writes the cached copy.
+        # The connection is borrowed first so an exhausted pool still answers 503.
+        borrowed = StreamConnection(await pool.getconn())
+        owner = path not in _export_locks
+        if owner:
+            _export_locks[path] = asyncio.Lock()
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return StreamingResponse(stream_csv(borrowed, query, params, path if owner else None),
+                                 media_type=spec["media_type"], headers=headers,
+                                 background=BackgroundTask(borrowed.release_unstarted))
 
-@app.get("/download/gpkg", summary="Download GeoPackage.")
-def download_gpkg():
-    gpkg_path = os.path.join("results", "my_features.gpkg")
-    if os.path.exists(gpkg_path):
-        return FileResponse(gpkg_path, media_type="application/geopackage+sqlite", filename="my_features.gpkg")
-    raise HTTPException(status_code=404, detail="GPKG not found")
\ No newline at end of file
+    lock = _export_locks.setdefault(path, asyncio.Lock())
+    async with lock:
+        if not os.path.exists(path):
+            async with pool.connection() as conn:
+                query_text = AsyncClientCursor(conn).mogrify(query, params)
+            await run_ogr2ogr(fmt, query_text, path)
+    _export_locks.pop(path, None)
+    return FileResponse(path, media_type=spec["media_type"], filename=filename, headers=headers)
@@ -2,15 +2,16 @@
     Скрипт читає Google Sheet через service account, нормалізує дані
     (особливо перетворює десяткові коми у long/lat на крапки), зберігає
     очищений CSV у папку results/, та опційно запускає трансформацію у PostGIS
+    (у тому ж процесі, без проміжного CSV)
 """
 from __future__ import annotations
 import argparse
 import os
-import sys
-import subprocess
-from typing import List, Optional
+import time
+from typing import Dict, List, Optional
 
-import pandas as pd
+from utils.cleaning import clean_coordinate_series, clean_number_series, sheet_values_to_df
+from scripts.transform_to_postgis import transform_and_load, timed, print_timings
 
 try:
     import gspread
@@ -45,9 +46,6 @@ def detect_value_columns(cols: List[str]) -> List[str]:
                     break
     return found
 
-def normalize_decimal_str_series(s: pd.Series) -> pd.Series:
-    return s.fillna("").astype(str).str.replace(r"[ \u00A0]", "", regex=True).str.replace(",", ".", regex=False).replace({"": None})
-
 # main
 def main():
     p = argparse.ArgumentParser()
@@ -55,27 +53,31 @@ def main():
     p.add_argument("--service-account", required=True, help="Path to service_account.json")
     p.add_argument("--worksheet-name", default=None, help="Worksheet name (optional)")
 # result file path
-    p.add_argument("--out", default="results/from_gsheet.csv", help="Output CSV path (default: results/from_gsheet.csv)")
-
-    p.add_argument("--run-transform", action="store_true", help="If set, call transform_to_postgis after saving CSV")
-    p.add_argument("--table", default="my_features", help="Table name to pass to transform script when --run-transform")
-    p.add_argument("--batch", type=int, default=500, help="Batch size to pass to transform script")
+    p.add_argument("--out", default=None,
+                   help="Output CSV path (default: results/from_gsheet.csv; with --run-transform only written when given)")
+
+    p.add_argument("--run-transform", action="store_true", help="If set, transform and load the cleaned data in-process")
+    p.add_argument("--table", default="my_features", help="Target table name when --run-transform")
+    p.add_argument("--batch", type=int, default=500, help="Progress reporting interval for the DB load")
+    p.add_argument("--db-url", help="Postgres connection URL for --run-transform")
+    p.add_argument("--dry-run", action="store_true", help="With --run-transform: write prepared files, skip the DB")
     args = p.parse_args()
-
-    out_dir = os.path.dirname(args.out) or "results"
-    os.makedirs(out_dir, exist_ok=True)
-
-    gc = gspread.service_account(filename=args.service_account)
-    sh = gc.open_by_key(args.sheet_id)
-    if args.worksheet_name:
-        ws = sh.worksheet(args.worksheet_name)
-    else:
-        ws = sh.get_worksheet(0)
-    values = ws.get_all_values()
+    if args.out is None and not args.run_transform:
+        args.out = "results/from_gsheet.csv"
+
+    timings: Dict[str, float] = {}
+    with timed(timings, "fetch"):
+        gc = gspread.service_account(filename=args.service_account)
+        sh = gc.open_by_key(args.sheet_id)
+        if args.worksheet_name:
+            ws = sh.worksheet(args.worksheet_name)
+        else:
+            ws = sh.get_worksheet(0)
+        values = ws.get_all_values()
     if not values:
         raise SystemExit("Sheet is empty or could not be read.")
-    df = pd.DataFrame(values[1:], columns=values[0])
-    df.columns = [str(c).strip() for c in df.columns]
+    df = sheet_values_to_df(values)
+    clean_started = time.perf_counter()
 
     cols = df.columns.tolist()
     lon_col = find_col_like(cols, ["long", "longitude", "lon", "lng", "Long", "Longitude"])
@@ -95,35 +97,31 @@ def main():
             lon_col, lat_col = cand[0], cand[1]
 
     if lon_col:
-        df[lon_col] = normalize_decimal_str_series(df[lon_col])
+        df[lon_col] = clean_coordinate_series(df[lon_col], "lon")
     if lat_col:
-        df[lat_col] = normalize_decimal_str_series(df[lat_col])
+        df[lat_col] = clean_coordinate_series(df[lat_col], "lat")
 
     for vc in value_cols:
         if vc in df.columns:
-            ser = df[vc].astype(str).str.replace(r"[ \u00A0]", "", regex=True).str.replace(",", ".", regex=False)
-            df[vc] = pd.to_numeric(ser, errors="coerce").fillna(0).astype(int)
-
-    df.to_csv(args.out, index=False, encoding="utf-8-sig")
-    print(f"Saved cleaned CSV to {args.out}")
+            df[vc] = clean_number_series(df[vc]).fillna(0).astype(int)
+    timings["clean"] = time.perf_counter() - clean_started
+
+    if args.out:
+        with timed(timings, "write_csv"):
+            os.makedirs(os.path.dirname(args.out) or "results", exist_ok=True)
+            df.to_csv(args.out, index=False, encoding="utf-8-sig")
+        print(f"Saved cleaned CSV to {args.out}")
     print("Detected columns:")
     print(" lon:", lon_col)
     print(" lat:", lat_col)
     print(" value columns (detected):", value_cols)
 
     if args.run_transform:
-        print("Running transform_to_postgis on saved CSV (outputs -> results/)...")
-        cmd = [
-            sys.executable, "-m", "scripts.transform_to_postgis",
-            "--input", args.out,
-            "--table", args.table,
-            "--batch", str(args.batch),
-            "--output-dir", "results"
-        ]
-        proc = subprocess.run(cmd)
-        if proc.returncode != 0:
-            raise SystemExit(f"transform_to_postgis exited with code {proc.returncode}")
+        print("Running transform_to_postgis on the cleaned data (outputs -> results/)...")
+        transform_and_load(df=df, table=args.table, db_url=args.db_url, batch=args.batch,
+                           output_dir="results", dry_run=args.dry_run, timings=timings)
         print("transform_to_postgis finished successfully.")
+    print_timings(timings)
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,30 @@
 from __future__ import annotations
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator
 from dotenv import load_dotenv
 from psycopg2 import sql
 import argparse
+import csv
+import time
+from contextlib import contextmanager
+from datetime import date
+import hashlib
+import itertools
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 import os
 import json
 import re
+import struct
 import sys
+import numpy as np
 import pandas as pd
 
+from utils.data_version import VERSION_TABLE, bump_data_version
+from utils.stats import refresh_stats, stats_table_name
+from utils.artifacts import ARTIFACT_FORMATS, ArtifactWriter, artifact_mode, is_artifact, iter_artifact_features
+from utils.cleaning import parse_number_column, parse_coordinate_column, parse_date_column, sheet_values_to_df
+from utils.fields import VALUE_FIELDS
+
 load_dotenv()
 
 try:
@@ -30,28 +46,6 @@ except Exception:
 
 # Helpers
 
-def normalize_number_str(s):
-    if s is None:
-        return None
-    if isinstance(s, (int, float)):
-        return s
-    s = str(s).strip()
-    if s == "":
-        return None
-    s = s.replace("\u00A0", "")
-    s = s.replace(" ", "")
-    s = s.replace("'", "").replace("’", "").replace("`", "")
-    s = s.replace(",", ".")
-    try:
-        if re.search(r"[.eE]", s):
-            return float(s)
-        return int(s)
-    except Exception:
-        try:
-            return float(s)
-        except Exception:
-            return None
-
 def find_col_like(cols, candidates):
     lower_map = {c.strip().lower(): c for c in cols}
     for cand in candidates:
@@ -83,11 +77,26 @@ def detect_value_columns(cols):
     return value_cols
 
 # Readers
+def sniff_delimiter(path: str, sample_size: int = 64 * 1024) -> str:
+    with open(path, "r", encoding="utf-8-sig", newline="") as fh:
+        sample = fh.read(sample_size)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
 def read_local_csv(path: str) -> pd.DataFrame:
-    df = pd.read_csv(path, dtype=str, engine='python', sep=None)
+    # sniff once, then let the C parser do the work (engine='python', sep=None is much slower)
+    df = pd.read_csv(path, dtype=str, sep=sniff_delimiter(path))
     df.columns = [str(c).strip() for c in df.columns]
     return df
 
+def iter_csv_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    reader = pd.read_csv(path, dtype=str, sep=sniff_delimiter(path), chunksize=chunk_size)
+    for chunk in reader:
+        chunk.columns = [str(c).strip() for c in chunk.columns]
+        yield chunk
+
 def download_public_csv(sheet_id: str, gid: int = 0, out_path: str = "._download.csv") -> str:
     if requests is None:
         raise RuntimeError("requests is required to download public sheet (install requests).")
@@ -110,90 +119,106 @@ def read_sheet_via_service_account(service_account_json: str, sheet_id: str, wor
     values = ws.get_all_values()
     if not values:
         return pd.DataFrame()
-    df = pd.DataFrame(values[1:], columns=values[0])
-    df = df.astype(str)
-    df.columns = [str(c).strip() for c in df.columns]
-    return df
+    return sheet_values_to_df(values)
 
 # Transformation logic
-def prepare_features_from_df(df: pd.DataFrame) -> Tuple[List[Dict], List[Dict], Dict]:
+RECORD_FIELDS = ["d_date", "t_region", "t_city", "long", "lat"]
+
+
+def column_values(df: pd.DataFrame, col: Optional[str]) -> np.ndarray:
+    if col is None:
+        return np.full(len(df), None, dtype=object)
+    return df[col].to_numpy(dtype=object)
+
+def detect_columns(df: pd.DataFrame) -> Dict:
     cols = list(df.columns)
     cols = [str(c).strip() for c in cols]
     df.columns = cols
 
-    date_col = find_col_like(cols, ["Дата", "date", "d_date", "Date"])
-    region_col = find_col_like(cols, ["Область", "region", "t_region", "Region"])
-    city_col = find_col_like(cols, ["Місто", "city", "t_city", "City"])
-    lon_col = find_col_like(cols, ["long", "longitude", "lon", "Long", "Longitude"])
-    lat_col = find_col_like(cols, ["lat", "latitude", "Lat", "LAT", "Latitude"])
     value_cols = detect_value_columns(cols)
     if value_cols is None:
         raise RuntimeError(f"Could not detect all value columns 1..10. Available columns: {cols}")
+    return {
+        "date_col": find_col_like(cols, ["Дата", "date", "d_date", "Date"]),
+        "region_col": find_col_like(cols, ["Область", "region", "t_region", "Region"]),
+        "city_col": find_col_like(cols, ["Місто", "city", "t_city", "City"]),
+        "lon_col": find_col_like(cols, ["long", "longitude", "lon", "Long", "Longitude"]),
+        "lat_col": find_col_like(cols, ["lat", "latitude", "Lat", "LAT", "Latitude"]),
+        "value_cols": value_cols
+    }
+
+def prepare_records_from_df(df: pd.DataFrame) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """
+    Columnar part of the transform: one entry per source row that yields at least
+    one point. Returns ({"d_date", "t_region", "t_city", "long", "lat", "counts"}, meta),
+    where counts is an (n_rows, 10) int array of the cleaned value columns.
+    """
+    meta = detect_columns(df)
+
+    counts = np.zeros((len(df), len(meta["value_cols"])), dtype=np.int64)
+    for k, c in enumerate(meta["value_cols"]):
+        nums, ok = parse_number_column(column_values(df, c))
+        ok &= np.isfinite(nums)
+        counts[:, k] = np.trunc(np.where(ok, nums, 0))
+    np.maximum(counts, 0, out=counts)
+
+    x, x_ok = parse_coordinate_column(column_values(df, meta["lon_col"]), "lon")
+    y, y_ok = parse_coordinate_column(column_values(df, meta["lat_col"]), "lat")
+    keep = (counts.max(axis=1, initial=0) > 0) & x_ok & y_ok
+
+    records = {
+        "d_date": parse_date_column(column_values(df, meta["date_col"])[keep]),
+        "t_region": column_values(df, meta["region_col"])[keep],
+        "t_city": column_values(df, meta["city_col"])[keep],
+        "long": x[keep],
+        "lat": y[keep],
+        "counts": counts[keep],
+    }
+    return records, meta
+
+def expand_records(records: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Expand each record into max(counts) points.
+    Returns (row index per point, (n_points, 10) 0/1 i_value matrix).
+    """
+    counts = records["counts"]
+    max_n = counts.max(axis=1, initial=0)
+    rows = np.repeat(np.arange(len(max_n)), max_n)
+    starts = np.cumsum(max_n) - max_n
+    pos = np.arange(len(rows)) - np.repeat(starts, max_n)
+    flags = (counts[rows] > pos[:, None]).astype(np.int64)
+    return rows, flags
+
+def build_features(records: Dict[str, np.ndarray], values: np.ndarray, rows: Optional[np.ndarray] = None) -> Tuple[List[Dict], List[Dict]]:
+    # rows selects (and repeats) records; values is aligned with the selected rows.
+    if rows is None:
+        rows = np.arange(len(values))
+    columns = [records[f][rows].tolist() for f in RECORD_FIELDS]
 
     features = []
     preview_rows = []
-    for _, row in df.iterrows():
-        counts = []
-        for c in value_cols:
-            raw = row.get(c, None)
-            num = normalize_number_str(raw)
-            if num is None:
-                n = 0
-            else:
-                try:
-                    n = int(float(num))
-                except Exception:
-                    n = 0
-            counts.append(max(0, n))
-        max_n = max(counts) if counts else 0
-        if max_n == 0:
-            continue
+    for d, r, c, x, y, v in zip(*columns, values.tolist()):
+        attrs = {"d_date": d, "t_region": r, "t_city": c, "long": x, "lat": y}
+        attrs.update(zip(VALUE_FIELDS, v))
+        features.append({"attributes": attrs, "wkt": f"POINT({x} {y})"})
+        preview_rows.append(attrs.copy())
+    return features, preview_rows
 
-        raw_lon = row.get(lon_col, None)
-        raw_lat = row.get(lat_col, None)
-        x_raw = normalize_number_str(raw_lon)
-        y_raw = normalize_number_str(raw_lat)
-        try:
-            x = float(x_raw)
-            y = float(y_raw)
-        except Exception:
-            continue
+def prepare_features_from_df(df: pd.DataFrame) -> Tuple[List[Dict], List[Dict], Dict]:
+    records, meta = prepare_records_from_df(df)
+    rows, flags = expand_records(records)
+    features, preview_rows = build_features(records, flags, rows)
+    return features, preview_rows, meta
 
-        d_raw = row.get(date_col, None)
-        d_date = None
-        if d_raw is not None and str(d_raw).strip() != "":
-            try:
-                d_date = pd.to_datetime(d_raw, dayfirst=True, errors='coerce')
-                if pd.isna(d_date):
-                    d_date = str(d_raw)
-                else:
-                    d_date = d_date.strftime("%Y-%m-%d")
-            except Exception:
-                d_date = str(d_raw)
-
-        for i in range(max_n):
-            attrs = {
-                "d_date": d_date,
-                "t_region": row.get(region_col),
-                "t_city": row.get(city_col),
-                "long": x,
-                "lat": y,
-            }
-            for k in range(len(counts)):
-                attrs[f"i_value_{k+1}"] = 1 if counts[k] > i else 0
-            geom_wkt = f"POINT({x} {y})"
-            feature = {"attributes": attrs, "wkt": geom_wkt}
-            features.append(feature)
-            preview_rows.append(attrs.copy())
-
-    meta = {
-        "date_col": date_col,
-        "region_col": region_col,
-        "city_col": city_col,
-        "lon_col": lon_col,
-        "lat_col": lat_col,
-        "value_cols": value_cols
-    }
+def prepare_weighted_features_from_df(df: pd.DataFrame) -> Tuple[List[Dict], List[Dict], Dict]:
+    """
+    One feature per source row; i_value_k holds the cleaned count instead of a 0/1 flag.
+    The expanded points are rebuilt in PostGIS by the {table}_points view.
+    """
+    records, meta = prepare_records_from_df(df)
+    if len(records["counts"]) and records["counts"].max() >= POINT_ID_STRIDE:
+        raise ValueError(f"Weighted rows are limited to {POINT_ID_STRIDE - 1} points (the {{table}}_points id stride)")
+    features, preview_rows = build_features(records, records["counts"])
     return features, preview_rows, meta
 
 # PostGIS operations
@@ -221,15 +246,32 @@ def get_db_conn(db_url: Optional[str] = None):
         return psycopg2.connect(db_url)
     raise RuntimeError("No DB connection info found. Provide --db-url or set PGHOST/PGUSER/PGPASSWORD or DATABASE_URL")
 
-def ensure_postgis_and_table(conn, table_name: str):
+def ensure_postgis_and_table(conn, table_name: str, mode: str = "expanded", staging: bool = False,
+                             partition: Optional[str] = None):
+    """
+    Create the extensions, the table (with missing columns added) and its indexes.
+    staging=True creates an UNLOGGED table without secondary indexes / points view,
+    to be filled and then swapped in by swap_in_staging.
+    partition="month"/"year" creates the table range-partitioned on d_date (plus a DEFAULT
+    partition for NULL dates); period partitions are added by insert_features_bulk.
+    """
     cur = conn.cursor()
-    try:
-        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
-    except Exception:
-        conn.rollback()
+    for ext in ("postgis", "pg_trgm"):
+        try:
+            cur.execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS {ext};").format(ext=sql.Identifier(ext)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+    # weighted rows keep counts in i_value_k; n_points is the number of expanded points
+    weighted_sql = sql.SQL(
+        "n_points INTEGER GENERATED ALWAYS AS (GREATEST(i_value_1, i_value_2, i_value_3, i_value_4, "
+        "i_value_5, i_value_6, i_value_7, i_value_8, i_value_9, i_value_10)) STORED,"
+    ) if mode == "weighted" else sql.SQL("")
+    if partition and partition not in PARTITIONINGS:
+        raise ValueError(f"Unsupported partitioning: {partition}")
     create_sql = sql.SQL("""
-    CREATE TABLE IF NOT EXISTS {tbl} (
-      id SERIAL PRIMARY KEY,
+    CREATE {unlogged} TABLE IF NOT EXISTS {tbl} (
+      id SERIAL {pk},
       d_date DATE,
       t_region TEXT,
       t_city TEXT,
@@ -238,86 +280,869 @@ def ensure_postgis_and_table(conn, table_name: str):
       i_value_1 INTEGER, i_value_2 INTEGER, i_value_3 INTEGER, i_value_4 INTEGER,
       i_value_5 INTEGER, i_value_6 INTEGER, i_value_7 INTEGER, i_value_8 INTEGER,
       i_value_9 INTEGER, i_value_10 INTEGER,
+      {weighted}
+      i_mask SMALLINT GENERATED ALWAYS AS ({mask}) STORED,
+      row_hash TEXT,
       geom geometry(Point,4326)
-    );
-    """).format(tbl=sql.Identifier(table_name))
+    ) {partition_by};
+    """).format(
+        tbl=sql.Identifier(table_name), weighted=weighted_sql, mask=i_mask_sql(),
+        # partitioned tables cannot be UNLOGGED, and their PK would have to include d_date (NOT NULL)
+        unlogged=sql.SQL("UNLOGGED" if staging and not partition else ""),
+        pk=sql.SQL("" if partition else "PRIMARY KEY"),
+        partition_by=sql.SQL("PARTITION BY RANGE (d_date)" if partition else ""),
+    )
     try:
+        existed = table_exists(cur, table_name)
+        if existed and table_mode(cur, table_name) != mode:
+            # weighted rows hold counts, expanded rows 0/1 flags: never mix them in one table
+            existing = table_mode(cur, table_name)
+            raise RuntimeError(f"{table_name} holds --mode {existing} rows; load it with --mode {existing} "
+                               f"or replace it with --swap --mode {mode}")
         cur.execute(create_sql)
+        if partition:
+            if not existed:
+                cur.execute(sql.SQL("COMMENT ON TABLE {tbl} IS {c};").format(
+                    tbl=sql.Identifier(table_name), c=sql.Literal(PARTITION_COMMENT.format(partition))))
+            if table_partitioning(cur, table_name) != partition:
+                raise RuntimeError(f"{table_name} exists and is not partitioned by {partition}; "
+                                   f"rebuild it with --swap --partition {partition}")
+        else:
+            partition = table_partitioning(cur, table_name)
+        if partition:
+            cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {part} PARTITION OF {tbl} DEFAULT;").format(
+                part=sql.Identifier(f"{table_name}_default"), tbl=sql.Identifier(table_name)))
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {idx} ON {tbl} (id);").format(
+                idx=sql.Identifier(f"{table_name}_id_idx"), tbl=sql.Identifier(table_name)))
+        # tables created before row_hash / i_mask existed
+        cur.execute(sql.SQL("ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS row_hash TEXT;").format(tbl=sql.Identifier(table_name)))
+        cur.execute(
+            sql.SQL("ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS i_mask SMALLINT GENERATED ALWAYS AS ({mask}) STORED;")
+            .format(tbl=sql.Identifier(table_name), mask=i_mask_sql())
+        )
+        # unique indexes of a partitioned table must contain d_date; row_hash already covers it
+        cur.execute(
+            sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {idx} ON {tbl} (row_hash{extra});")
+            .format(idx=sql.Identifier(f"{table_name}_row_hash_key"), tbl=sql.Identifier(table_name),
+                    extra=sql.SQL(", d_date" if partition else ""))
+        )
     except Exception:
         conn.rollback()
         raise
-    idx_name = f"{table_name}_geom_gist"
+    conn.commit()
+    if staging:
+        cur.close()
+        return
+    create_indexes(conn, table_name)
+    if mode == "weighted":
+        ensure_points_view(cur, table_name)
+    conn.commit()
+    cur.close()
+
+
+def table_mode(cur, table_name: str) -> Optional[str]:
+    """"weighted" if the table has the n_points column of weighted tables, "expanded" otherwise; None if missing."""
+    if not table_exists(cur, table_name):
+        return None
+    cur.execute(
+        "SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'n_points' AND NOT attisdropped",
+        (sql.Identifier(table_name).as_string(cur),),
+    )
+    return "weighted" if cur.fetchone() else "expanded"
+
+PARTITIONINGS = ("month", "year")
+PARTITION_COMMENT = "partitioned by d_date: {}"
+
+def table_partitioning(cur, table_name: str) -> Optional[str]:
+    """
+    "month" / "year" for a table range-partitioned on d_date, else None. Read from the catalog:
+    the period is the width of an existing partition; the table comment only decides it for a
+    table that has no period partitions yet.
+    """
+    cur.execute(
+        "SELECT pg_get_partkeydef(c.oid), obj_description(c.oid, 'pg_class') FROM pg_class c "
+        "WHERE c.oid = to_regclass(%s) AND c.relkind = 'p'",
+        (sql.Identifier(table_name).as_string(cur),),
+    )
+    row = cur.fetchone()
+    if not row or row[0] != "RANGE (d_date)":
+        return None
+    for _, lower, upper in list_partitions(cur, table_name):
+        if lower is not None:
+            return "year" if partition_end(lower, "year") == upper else "month"
+    for name in PARTITIONINGS:
+        if row[1] == PARTITION_COMMENT.format(name):
+            return name
+    return "month"
+
+def partition_end(start, partition: str):
+    if partition == "year":
+        return start.replace(year=start.year + 1)
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+def partition_name(table_name: str, start, partition: str) -> str:
+    return f"{table_name}_p{start:%Y_%m}" if partition == "month" else f"{table_name}_p{start:%Y}"
+
+def ensure_partitions(cur, table_name: str, partition: str, source: sql.Composable) -> List[str]:
+    """Create the missing period partitions for the d_date values of source (a table with a text d_date)."""
+    cur.execute(sql.SQL(
+        "SELECT DISTINCT date_trunc({unit}, d_date::date)::date FROM {src} WHERE d_date IS NOT NULL"
+    ).format(unit=sql.Literal(partition), src=source))
+    starts = [start for (start,) in cur.fetchall()]
+    attached = {name for name, _, _ in list_partitions(cur, table_name)}
+    created = []
+    for start in starts:
+        name = partition_name(table_name, start, partition)
+        if name in attached:
+            continue
+        # a detached partition of the same period only keeps its name out of the way
+        park_detached_partition(cur, name)
+        end = partition_end(start, partition)
+        moved = take_default_rows(cur, table_name, start, end)
+        cur.execute(sql.SQL("CREATE TABLE {part} PARTITION OF {tbl} FOR VALUES FROM ({start}) TO ({end});").format(
+            part=sql.Identifier(name), tbl=sql.Identifier(table_name),
+            start=sql.Literal(start), end=sql.Literal(end)))
+        if moved:
+            restore_rows(cur, table_name, moved)
+        created.append(name)
+    if created:
+        print(f"Created partitions: {', '.join(created)}")
+    return created
+
+def park_detached_partition(cur, name: str) -> Optional[str]:
+    """Rename a relation called name that is not an attached partition (and its indexes) to {name}_detached[_N]."""
+    cur.execute("SELECT relispartition FROM pg_class WHERE oid = to_regclass(%s)", (sql.Identifier(name).as_string(cur),))
+    row = cur.fetchone()
+    if row is None or row[0]:
+        return None
+    new, n = f"{name}_detached", 1
+    while table_exists(cur, new):
+        n += 1
+        new = f"{name}_detached_{n}"
+    rename_table(cur, name, new)
+    return new
+
+def take_default_rows(cur, table_name: str, start, end) -> Optional[str]:
+    """
+    Move rows of [start, end) out of the DEFAULT partition into a temp table (a new period
+    partition cannot be created while DEFAULT holds rows of it). Returns the temp table or None.
+    """
+    default = sql.Identifier(f"{table_name}_default")
+    cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {d} WHERE d_date >= %s AND d_date < %s)").format(d=default),
+                (start, end))
+    if not cur.fetchone()[0]:
+        return None
+    moved = f"_moved_{table_name}"
+    cur.execute(sql.SQL("CREATE TEMP TABLE {m} (LIKE {d}) ON COMMIT DROP;").format(m=sql.Identifier(moved), d=default))
+    cur.execute(sql.SQL(
+        "WITH d AS (DELETE FROM {d} WHERE d_date >= %s AND d_date < %s RETURNING *) INSERT INTO {m} SELECT * FROM d"
+    ).format(d=default, m=sql.Identifier(moved)), (start, end))
+    return moved
+
+def restore_rows(cur, table_name: str, moved: str):
+    # generated columns (i_mask, n_points) are recomputed on insert
+    cur.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attnum > 0 "
+        "AND NOT attisdropped AND attgenerated = '' ORDER BY attnum",
+        (sql.Identifier(table_name).as_string(cur),),
+    )
+    cols = sql.SQL(", ").join(sql.Identifier(c) for (c,) in cur.fetchall())
+    cur.execute(sql.SQL("INSERT INTO {tbl} ({cols}) SELECT {cols} FROM {m}; DROP TABLE {m};").format(
+        tbl=sql.Identifier(table_name), cols=cols, m=sql.Identifier(moved)))
+
+def list_partitions(cur, table_name: str) -> List[Tuple[str, Optional[date], Optional[date]]]:
+    """(partition, from, to) of a partitioned table; from/to are None for the DEFAULT partition."""
+    cur.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s) ORDER BY 1",
+        (sql.Identifier(table_name).as_string(cur),),
+    )
+    out = []
+    for name, bound in cur.fetchall():
+        m = re.search(r"FROM \('([^']+)'\) TO \('([^']+)'\)", bound or "")
+        out.append((name, date.fromisoformat(m.group(1)), date.fromisoformat(m.group(2))) if m else (name, None, None))
+    return out
+
+def retire_partitions(conn, table_name: str, before: date, drop: bool = False) -> List[str]:
+    """
+    Retention: detach (and with drop=True drop) every period partition that ends on or
+    before the date `before`. Much cheaper than DELETE and leaves no bloat behind.
+    Detached partitions are renamed to {partition}_detached so later loads can
+    create that period again.
+    """
+    if not isinstance(before, date):
+        before = date.fromisoformat(before)
+    cur = conn.cursor()
+    retired = []
     try:
-        cur.execute(
-            sql.SQL("CREATE INDEX IF NOT EXISTS {idx} ON {tbl} USING GIST (geom);")
-            .format(idx=sql.Identifier(idx_name), tbl=sql.Identifier(table_name))
-        )
+        for name, _, upper in list_partitions(cur, table_name):
+            if upper is None or upper > before:
+                continue
+            cur.execute(sql.SQL("ALTER TABLE {tbl} DETACH PARTITION {part};").format(
+                tbl=sql.Identifier(table_name), part=sql.Identifier(name)))
+            if drop:
+                cur.execute(sql.SQL("DROP TABLE {part};").format(part=sql.Identifier(name)))
+                retired.append(name)
+            else:
+                retired.append(park_detached_partition(cur, name))
+        if retired:
+            refresh_stats(cur, table_name)
+            bump_data_version(cur, table_name)
+        conn.commit()
     except Exception:
         conn.rollback()
+        raise
+    finally:
+        cur.close()
+    print(f"{'Dropped' if drop else 'Detached'} partitions of {table_name} before {before}: {retired or 'none'}")
+    return retired
+
+def i_mask_sql(alias: Optional[str] = None, above: sql.Composable = sql.Literal(0)) -> sql.Composable:
+    # bit k-1 is set when i_value_k > above (0 for the table itself);
+    # the API filters with i_mask = ANY(<matching masks>)
+    return sql.SQL("(") + sql.SQL(" | ").join(
+        sql.SQL("(({c} > {above})::int << {bit})").format(
+            c=sql.Identifier(alias, c) if alias else sql.Identifier(c), above=above, bit=sql.Literal(k))
+        for k, c in enumerate(VALUE_FIELDS)
+    ) + sql.SQL(")::smallint")
+
+def table_indexes(table_name: str) -> List[Tuple[str, sql.Composable]]:
+    """(index name, index definition) for the secondary indexes that the API queries rely on."""
+    return [
+        (f"{table_name}_geom_gist", sql.SQL("USING GIST (geom)")),
+        (f"{table_name}_d_date_idx", sql.SQL("(d_date)")),
+        (f"{table_name}_i_mask_idx", sql.SQL("(i_mask)")),
+        (f"{table_name}_t_region_trgm", sql.SQL("USING GIN (t_region gin_trgm_ops)")),
+        (f"{table_name}_t_city_trgm", sql.SQL("USING GIN (t_city gin_trgm_ops)")),
+    ]
+
+def create_indexes(conn, table_name: str) -> List[str]:
+    """Create missing secondary indexes, each in its own transaction. Returns the ones that failed."""
+    failed = []
+    cur = conn.cursor()
+    for idx_name, definition in table_indexes(table_name):
+        try:
+            cur.execute(
+                sql.SQL("CREATE INDEX IF NOT EXISTS {idx} ON {tbl} {definition};")
+                .format(idx=sql.Identifier(idx_name), tbl=sql.Identifier(table_name), definition=definition)
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            failed.append(idx_name)
+            print(f"Could not create index {idx_name}: {str(e).strip()}")
+    cur.close()
+    return failed
+
+def drop_indexes(conn, table_name: str):
+    # for very large loads: drop -> load -> create_indexes is faster than maintaining them row by row
+    cur = conn.cursor()
+    for idx_name, _ in table_indexes(table_name):
+        cur.execute(sql.SQL("DROP INDEX IF EXISTS {idx};").format(idx=sql.Identifier(idx_name)))
+    conn.commit()
+    cur.close()
+
+def run_maintenance(conn, table_name: str, reindex: bool = True, cluster: bool = False):
+    """Recreate missing indexes, optionally REINDEX and CLUSTER on the geom index, then ANALYZE."""
+    create_indexes(conn, table_name)
+    tbl = sql.Identifier(table_name)
+    cur = conn.cursor()
+    if reindex:
+        print(f"REINDEX TABLE {table_name}")
+        cur.execute(sql.SQL("REINDEX TABLE {tbl};").format(tbl=tbl))
+        conn.commit()
+    if cluster:
+        # rewrites the table in spatial order; takes an ACCESS EXCLUSIVE lock while it runs
+        print(f"CLUSTER {table_name} USING {table_name}_geom_gist")
+        cur.execute(sql.SQL("CLUSTER {tbl} USING {idx};").format(tbl=tbl, idx=sql.Identifier(f"{table_name}_geom_gist")))
+        conn.commit()
+    cur.close()
+    analyze_table(conn, table_name)
+
+def analyze_table(conn, table_name: str):
+    cur = conn.cursor()
+    cur.execute(sql.SQL("ANALYZE {tbl};").format(tbl=sql.Identifier(table_name)))
+    conn.commit()
+    cur.close()
+
+
+# point ids of the {table}_points view: source id * POINT_ID_STRIDE + point index
+POINT_ID_STRIDE = 1000000
+
+def ensure_points_view(cur, table_name: str):
+    # Expanded form of a weighted table: same rows and i_value_k flags as --mode expanded.
+    flags = sql.SQL(", ").join(
+        sql.SQL("(t.{c} > g.i)::int AS {c}").format(c=sql.Identifier(c)) for c in VALUE_FIELDS
+    )
+    view = sql.Identifier(f"{table_name}_points")
+    # dropped and recreated: CREATE OR REPLACE cannot change the columns of an older view
+    cur.execute(sql.SQL("DROP VIEW IF EXISTS {view};").format(view=view))
+    cur.execute(sql.SQL("""
+    CREATE VIEW {view} AS
+    SELECT t.id::bigint * {stride} + g.i AS id, t.id AS source_id, g.i AS point_index, t.d_date, t.t_region, t.t_city, t.long, t.lat,
+      {flags}, {mask} AS i_mask, t.geom
+    FROM {tbl} t
+    CROSS JOIN LATERAL generate_series(0, t.n_points - 1) AS g(i);
+    """).format(view=view, tbl=sql.Identifier(table_name), flags=flags, stride=sql.Literal(POINT_ID_STRIDE),
+                # per point, from the same flags (the API filters and decodes it)
+                mask=i_mask_sql("t", sql.SQL("g.i"))))
+
+
+def staging_table_name(table_name: str) -> str:
+    return f"{table_name}_staging"
+
+def previous_table_name(table_name: str) -> str:
+    return f"{table_name}_prev"
+
+def table_exists(cur, table_name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (sql.Identifier(table_name).as_string(cur),))
+    return cur.fetchone()[0]
+
+def rename_table(cur, old: str, new: str):
+    """
+    Rename a table together with its indexes / constraints, id sequence, partitions
+    and summary table ({old}_* -> {new}_*).
+    """
+    cur.execute(sql.SQL("ALTER TABLE {old} RENAME TO {new};").format(old=sql.Identifier(old), new=sql.Identifier(new)))
+    for part, _, _ in list_partitions(cur, new):
+        if part.startswith(old + "_"):
+            park_detached_partition(cur, new + part[len(old):])
+            rename_table(cur, part, new + part[len(old):])
+    cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s", (new,))
+    for (idx_name,) in cur.fetchall():
+        if idx_name.startswith(old + "_"):
+            cur.execute(sql.SQL("ALTER INDEX {idx} RENAME TO {new_idx};").format(
+                idx=sql.Identifier(idx_name), new_idx=sql.Identifier(new + idx_name[len(old):])))
+    cur.execute(sql.SQL("ALTER SEQUENCE IF EXISTS {seq} RENAME TO {new_seq};").format(
+        seq=sql.Identifier(f"{old}_id_seq"), new_seq=sql.Identifier(f"{new}_id_seq")))
+    # the summary table travels with its table
+    if table_exists(cur, stats_table_name(old)):
+        rename_table(cur, stats_table_name(old), stats_table_name(new))
+
+def prepare_staging_table(conn, table_name: str, mode: str = "expanded", partition: Optional[str] = None) -> str:
+    staging = staging_table_name(table_name)
+    cur = conn.cursor()
+    for tbl in (staging, stats_table_name(staging)):
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {tbl} CASCADE;").format(tbl=sql.Identifier(tbl)))
+    # keep the live table's partitioning unless a different one is asked for
+    partition = partition or table_partitioning(cur, table_name)
     conn.commit()
     cur.close()
+    ensure_postgis_and_table(conn, staging, mode=mode, staging=True, partition=partition)
+    return staging
+
+def finish_staging_table(conn, staging: str, cluster: bool = False):
+    # SET LOGGED rewrites the table into the WAL, so it survives a crash once it is live
+    # (partitioned staging tables are created logged)
+    cur = conn.cursor()
+    if table_partitioning(cur, staging) is None:
+        cur.execute(sql.SQL("ALTER TABLE {tbl} SET LOGGED;").format(tbl=sql.Identifier(staging)))
+    conn.commit()
+    cur.close()
+    failed = create_indexes(conn, staging)
+    if failed:
+        raise RuntimeError(f"Could not build indexes on {staging}: {failed}")
+    run_maintenance(conn, staging, reindex=False, cluster=cluster)
+
+def sync_points_view(cur, table_name: str):
+    """(Re)point {table}_points at table_name if it is weighted, drop a leftover view otherwise."""
+    if table_mode(cur, table_name) == "weighted":
+        ensure_points_view(cur, table_name)
+    else:
+        cur.execute(sql.SQL("DROP VIEW IF EXISTS {view};").format(view=sql.Identifier(f"{table_name}_points")))
+
+def swap_in_staging(conn, table_name: str, lock_timeout: str = "10s"):
+    """
+    In one short transaction: drop {table}_prev, rename {table} -> {table}_prev and
+    {table}_staging -> {table}. Readers block only for the renames, never see a partial table.
+    """
+    staging, prev = staging_table_name(table_name), previous_table_name(table_name)
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        for tbl in (prev, stats_table_name(prev)):
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {tbl} CASCADE;").format(tbl=sql.Identifier(tbl)))
+        if table_exists(cur, table_name):
+            rename_table(cur, table_name, prev)
+        rename_table(cur, staging, table_name)
+        sync_points_view(cur, table_name)
+        version = bump_data_version(cur, table_name)
+        # rows earlier loads left under the staging name; nothing reads them
+        cur.execute(sql.SQL("DELETE FROM {vt} WHERE table_name = %s;").format(vt=sql.Identifier(VERSION_TABLE)),
+                    (staging,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    print(f"Swapped {staging} in as {table_name} (previous version kept as {prev})")
+    return version
 
+def rollback_swap(conn, table_name: str, lock_timeout: str = "10s"):
+    """Swap {table} and {table}_prev back (undoes the last swap_in_staging)."""
+    staging, prev = staging_table_name(table_name), previous_table_name(table_name)
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        if not table_exists(cur, prev):
+            raise RuntimeError(f"No previous version {prev} to roll back to")
+        for tbl in (staging, stats_table_name(staging)):
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {tbl} CASCADE;").format(tbl=sql.Identifier(tbl)))
+        rename_table(cur, table_name, staging)
+        rename_table(cur, prev, table_name)
+        rename_table(cur, staging, prev)
+        sync_points_view(cur, table_name)
+        bump_data_version(cur, table_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    print(f"Rolled back {table_name} to the previous version ({prev} now holds the replaced one)")
 
 def truncate_table(conn, table_name: str):
     cur = conn.cursor()
-    cur.execute(f"TRUNCATE TABLE {extras.Identifier(table_name).string};")
+    cur.execute(sql.SQL("TRUNCATE TABLE {tbl};").format(tbl=sql.Identifier(table_name)))
+    refresh_stats(cur, table_name)
+    bump_data_version(cur, table_name)
     conn.commit()
     cur.close()
 
-def insert_features_bulk(conn, table_name: str, features: List[Dict], batch_size: int = 500) -> Dict:
-    results = {"inserted": 0, "batches": []}
-    if not features:
+COPY_FIELDS = (
+    [("d_date", "text"), ("t_region", "text"), ("t_city", "text"), ("long", "float8"), ("lat", "float8")]
+    + [(c, "int4") for c in VALUE_FIELDS]
+    + [("row_hash", "text")]
+)
+COPY_COLUMNS = [c for c, _ in COPY_FIELDS]
+PG_TYPES = {"text": "TEXT", "float8": "DOUBLE PRECISION", "int4": "INTEGER"}
+PGCOPY_HEADER = b"PGCOPY\n\377\r\n\0" + struct.pack(">ii", 0, 0)
+
+
+class IterStream:
+    """Minimal read()-able file over an iterator of bytes, for cursor.copy_expert."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            out, self._buf = self._buf, b""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+
+def is_copy_null(v, pg_type: str) -> bool:
+    # NaN in text columns is a pandas missing value; NaN coordinates stay NaN
+    return v is None or (pg_type == "text" and isinstance(v, float) and v != v)
+
+def copy_text_value(v, pg_type: str) -> str:
+    if is_copy_null(v, pg_type):
+        return "\\N"
+    if pg_type == "float8":
+        return repr(float(v))
+    if pg_type == "int4":
+        return str(int(v))
+    return (str(v).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def copy_binary_value(v, pg_type: str) -> bytes:
+    if is_copy_null(v, pg_type):
+        return struct.pack(">i", -1)
+    if pg_type == "float8":
+        return struct.pack(">id", 8, float(v))
+    if pg_type == "int4":
+        return struct.pack(">ii", 4, int(v))
+    b = str(v).encode("utf-8")
+    return struct.pack(">i", len(b)) + b
+
+def copy_text_rows(features: Iterable[Dict]):
+    for n, f in enumerate(features):
+        a = f["attributes"]
+        line = [str(n)] + [copy_text_value(a.get(c), t) for c, t in COPY_FIELDS]
+        yield ("\t".join(line) + "\n").encode("utf-8")
+
+def copy_binary_rows(features: Iterable[Dict]):
+    # tuples only; the caller wraps them in PGCOPY_HEADER and the -1 trailer
+    ncols = struct.pack(">h", 1 + len(COPY_FIELDS))
+    for n, f in enumerate(features):
+        a = f["attributes"]
+        parts = [ncols, struct.pack(">iq", 8, n)]
+        parts.extend(copy_binary_value(a.get(c), t) for c, t in COPY_FIELDS)
+        yield b"".join(parts)
+
+def with_progress(rows, total: Optional[int], every: int):
+    sent = 0
+    for chunk in rows:
+        yield chunk
+        sent += 1
+        if every and sent % every == 0:
+            print(f"COPY progress: {sent}/{total} rows" if total is not None else f"COPY progress: {sent} rows")
+
+def add_row_hashes(features: List[Dict], preview_rows: Optional[List[Dict]], seen: Counter):
+    """
+    Set attributes["row_hash"]: sha1 of the feature content plus an occurrence number,
+    so identical features (repeated points of one row, duplicated sheet rows) still get
+    distinct, stable keys. seen carries occurrence counts across chunks.
+    """
+    for f, prev in zip(features, preview_rows if preview_rows is not None else itertools.repeat(None)):
+        a = f["attributes"]
+        content = json.dumps([a.get(c) for c in RECORD_FIELDS + VALUE_FIELDS], ensure_ascii=False, default=str)
+        base = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        n = seen[base]
+        seen[base] += 1
+        a["row_hash"] = hashlib.sha1(f"{base}:{n}".encode("ascii")).hexdigest()
+        if prev is not None:
+            prev["row_hash"] = a["row_hash"]
+
+def insert_features_bulk(conn, table_name: str, features: Iterable[Dict], batch_size: int = 500,
+                         copy_format: str = "text", sync: bool = False, bump_version: bool = True) -> Dict:
+    """
+    Load features with COPY ... FROM STDIN into a temp staging table, then build geom
+    with ST_MakePoint(long, lat) in a single INSERT ... SELECT. One transaction per load;
+    batch_size only controls how often progress is printed.
+    features may be a lazy iterable: it is consumed while COPY streams.
+
+    sync=True makes the table match the features by row_hash: rows whose hash is gone
+    are deleted, only new hashes are inserted and unchanged rows are left untouched.
+    bump_version=False is for a --swap staging table: the swap bumps the live table's version.
+    """
+    results = {"inserted": 0, "ok": True, "format": copy_format}
+    if sync:
+        results["deleted"] = 0
+    total = len(features) if hasattr(features, "__len__") else None
+    if total == 0 and not sync:
         return results
+    if copy_format not in ("text", "binary"):
+        raise ValueError(f"Unsupported COPY format: {copy_format}")
 
+    staging = f"_copy_{table_name}"
+    col_defs = ", ".join(f"{c} {PG_TYPES[t]}" for c, t in COPY_FIELDS)
+    cols = sql.SQL(", ").join(sql.Identifier(c) for c in COPY_COLUMNS)
+    tbl = sql.Identifier(table_name)
+    stg = sql.Identifier(staging)
     cur = conn.cursor()
-    cols = [
-        "d_date", "t_region", "t_city", "long", "lat",
-        "i_value_1","i_value_2","i_value_3","i_value_4","i_value_5",
-        "i_value_6","i_value_7","i_value_8","i_value_9","i_value_10"
-    ]
-    cols_sql = ", ".join(cols) + ", geom"
-    vals_template = "(" + ",".join(["%s"] * len(cols)) + ", ST_GeomFromText(%s, 4326))"
+    try:
+        cur.execute(sql.SQL("CREATE TEMP TABLE {stg} (n BIGINT, " + col_defs + ") ON COMMIT DROP").format(stg=stg))
 
-    insert_sql_composed = sql.SQL("INSERT INTO {tbl} ({cols}) VALUES %s").format(
-        tbl=sql.Identifier(table_name),
-        cols=sql.SQL(cols_sql)
-    )
-    insert_sql = insert_sql_composed.as_string(conn)
+        if copy_format == "binary":
+            rows = with_progress(copy_binary_rows(features), total, batch_size)
+            rows = itertools.chain([PGCOPY_HEADER], rows, [struct.pack(">h", -1)])
+        else:
+            rows = with_progress(copy_text_rows(features), total, batch_size)
+        copy_sql = sql.SQL("COPY {stg} (n, {cols}) FROM STDIN WITH (FORMAT {fmt})").format(
+            stg=stg, cols=cols, fmt=sql.SQL(copy_format)
+        )
+        cur.copy_expert(copy_sql.as_string(conn), IterStream(rows))
+        partition = table_partitioning(cur, table_name)
+        if partition:
+            ensure_partitions(cur, table_name, partition, stg)
+
+        new_only = sql.SQL("")
+        if sync:
+            cur.execute(sql.SQL("ANALYZE {stg}").format(stg=stg))
+            cur.execute(sql.SQL(
+                "DELETE FROM {tbl} t WHERE NOT EXISTS (SELECT 1 FROM {stg} s WHERE s.row_hash = t.row_hash)"
+            ).format(tbl=tbl, stg=stg))
+            results["deleted"] = cur.rowcount
+            new_only = sql.SQL("WHERE NOT EXISTS (SELECT 1 FROM {tbl} t WHERE t.row_hash = s.row_hash)").format(tbl=tbl)
+        cur.execute(sql.SQL(
+            "INSERT INTO {tbl} ({cols}, geom) "
+            "SELECT s.d_date::date, s.t_region, s.t_city, s.long, s.lat, {vals}, s.row_hash, "
+            "ST_SetSRID(ST_MakePoint(s.long, s.lat), 4326) FROM {stg} s {new_only} ORDER BY s.n"
+        ).format(
+            tbl=tbl, cols=cols, stg=stg, new_only=new_only,
+            vals=sql.SQL(", ").join(sql.SQL("s.") + sql.Identifier(c) for c in VALUE_FIELDS),
+        ))
+        results["inserted"] = cur.rowcount
+        changed = results["inserted"] or results.get("deleted")
+        if changed:
+            results["stats_rows"] = refresh_stats(cur, table_name)
+            if bump_version:
+                results["data_version"] = bump_data_version(cur, table_name)
+        conn.commit()
+        print(f"COPY finished: {results['inserted']} rows inserted"
+              + (f", {results['deleted']} deleted" if sync else ""))
+        if changed:
+            analyze_table(conn, table_name)
+    except Exception as e:
+        conn.rollback()
+        results["ok"] = False
+        results["error"] = str(e)
+    finally:
+        cur.close()
+    return results
+
+
+PREPARERS = {
+    "expanded": prepare_features_from_df,
+    "weighted": prepare_weighted_features_from_df,
+}
 
-    rows = []
+
+def prepare_chunk(prepare, chunk: pd.DataFrame) -> Tuple[int, List[Dict], List[Dict]]:
+    features, preview_rows, _ = prepare(chunk)
+    return len(chunk), features, preview_rows
+
+def map_chunks(prepare, chunks: Iterable[pd.DataFrame], workers: int = 1) -> Iterator[Tuple[int, List[Dict], List[Dict]]]:
+    """
+    Yield prepare_chunk results in input order. With workers > 1 chunks are transformed
+    in a process pool, keeping at most 2 * workers chunks in flight so memory stays bounded.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield prepare_chunk(prepare, chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(prepare_chunk, prepare, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_ndjson(fh, features: Iterable[Dict]) -> int:
+    n = 0
     for f in features:
-        a = f["attributes"]
-        row = [
-            a.get("d_date"),
-            a.get("t_region"),
-            a.get("t_city"),
-            a.get("long"),
-            a.get("lat"),
-            a.get("i_value_1"), a.get("i_value_2"), a.get("i_value_3"), a.get("i_value_4"), a.get("i_value_5"),
-            a.get("i_value_6"), a.get("i_value_7"), a.get("i_value_8"), a.get("i_value_9"), a.get("i_value_10"),
-            f.get("wkt")
-        ]
-        rows.append(tuple(row))
-
-    from psycopg2.extras import execute_values
-    for i in range(0, len(rows), batch_size):
-        chunk = rows[i:i+batch_size]
+        fh.write(json.dumps(f, ensure_ascii=False, separators=(",", ":")))
+        fh.write("\n")
+        n += 1
+    return n
+
+def stream_features(chunks: Iterable[pd.DataFrame], prepare, features_out: str, preview_out: str, stats: Dict,
+                    workers: int = 1, row_hashes: Optional[Counter] = None,
+                    output_format: str = "ndjson", mode: str = "expanded") -> Iterator[Dict]:
+    """
+    Transform chunk by chunk, appending each chunk to the features file and preview CSV
+    (or, for parquet/arrow, to the single columnar artifact) before handing its features on.
+    Only a bounded number of chunks is held in memory.
+    """
+    if output_format in ARTIFACT_FORMATS:
+        with ArtifactWriter(features_out, output_format, mode) as writer:
+            for n_rows, features, _ in map_chunks(prepare, chunks, workers):
+                stats["rows"] += n_rows
+                if row_hashes is not None:
+                    add_row_hashes(features, None, row_hashes)
+                stats["features"] += writer.write(features)
+                yield from features
+        return
+    with open(features_out, "w", encoding="utf-8") as jfh, open(preview_out, "w", encoding="utf-8-sig", newline="") as pfh:
+        if output_format == "json":
+            jfh.write("[")
+        for n_rows, features, preview_rows in map_chunks(prepare, chunks, workers):
+            stats["rows"] += n_rows
+            if row_hashes is not None:
+                add_row_hashes(features, preview_rows, row_hashes)
+            if output_format == "json":
+                for f in features:
+                    jfh.write(",\n" if stats["features"] else "\n")
+                    json.dump(f, jfh, ensure_ascii=False)
+                    stats["features"] += 1
+            else:
+                stats["features"] += write_ndjson(jfh, features)
+            if preview_rows:
+                pd.DataFrame(preview_rows).to_csv(pfh, index=False, header=pfh.tell() == 0)
+            yield from features
+        if output_format == "json":
+            jfh.write("\n]\n")
+
+
+@contextmanager
+def timed(timings: Optional[Dict[str, float]], stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+def print_timings(timings: Dict[str, float]):
+    if timings:
+        print("Stage timings: " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items())
+              + f" (total {sum(timings.values()):.2f}s)")
+
+def transform_and_load(df: Optional[pd.DataFrame] = None, csv_path: Optional[str] = None,
+                       table: str = "transformed_features", db_url: Optional[str] = None, mode: str = "expanded",
+                       output_dir: str = "results", output_format: str = "ndjson", batch: int = 500,
+                       copy_format: str = "text", dry_run: bool = False, truncate: bool = False,
+                       stream: bool = False, chunk_size: int = 10000, workers: int = 1,
+                       rebuild_indexes: bool = False, cluster: bool = False, sync: bool = False,
+                       timings: Optional[Dict[str, float]] = None, swap: bool = False,
+                       partition: Optional[str] = None) -> Dict:
+    """
+    Transform a DataFrame (or, with stream=True and no df, the CSV at csv_path) into features,
+    write {table}.{output_format} + preview CSV into output_dir and load them into PostGIS
+    unless dry_run. Per-stage seconds are added to timings. Used by main() and fetch_gs.
+    """
+    if workers > 1:
+        stream = True
+    prepare = PREPARERS[mode]
+    os.makedirs(output_dir, exist_ok=True)
+    json_out = os.path.join(output_dir, f"{table}.{output_format}")
+    preview_out = os.path.join(output_dir, f"{table}_preview.csv")
+    # parquet/arrow artifacts carry everything; no preview CSV is written next to them
+    written = json_out if output_format in ARTIFACT_FORMATS else f"{json_out}, {preview_out}"
+
+    stats = {"rows": 0, "features": 0}
+    if stream:
+        if df is None:
+            chunks = iter_csv_chunks(csv_path, chunk_size)
+        else:
+            chunks = (df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size))
+        # read + transform + load interleave, so they are timed together as "stream"
+        features = stream_features(chunks, prepare, json_out, preview_out, stats, workers=workers,
+                                   row_hashes=Counter() if sync else None, output_format=output_format, mode=mode)
+    else:
+        print(f"Read {len(df)} rows from source")
+        stats["rows"] = len(df)
+
+        with timed(timings, "transform"):
+            features, preview_rows, meta = prepare(df)
+            if sync:
+                add_row_hashes(features, preview_rows, Counter())
+        stats["features"] = len(features)
+        print(f"Prepared {len(features)} features")
+
+        with timed(timings, "write_files"):
+            if output_format in ARTIFACT_FORMATS:
+                with ArtifactWriter(json_out, output_format, mode) as writer:
+                    writer.write(features)
+            else:
+                with open(json_out, "w", encoding="utf-8") as fh:
+                    if output_format == "json":
+                        json.dump(features, fh, ensure_ascii=False, indent=2)
+                    else:
+                        write_ndjson(fh, features)
+                if preview_rows:
+                    pd.DataFrame(preview_rows).to_csv(preview_out, index=False, encoding='utf-8-sig')
+        print(f"Wrote prepared features: {json_out}")
+        if output_format not in ARTIFACT_FORMATS:
+            print(f"Wrote preview CSV: {preview_out}")
+
+    if dry_run:
+        if stream:
+            with timed(timings, "stream"):
+                for _ in features:
+                    pass
+            print(f"Streamed {stats['rows']} rows -> {stats['features']} features into {written}")
+        print("Dry-run: skipping DB write")
+        return stats
+
+    stats["load"] = load_into_postgis(
+        features, table, db_url=db_url, mode=mode, batch=batch, copy_format=copy_format, truncate=truncate,
+        rebuild_indexes=rebuild_indexes, cluster=cluster, sync=sync, timings=timings,
+        stage="stream" if stream else "load", swap=swap, partition=partition,
+    )
+    if stream:
+        print(f"Streamed {stats['rows']} rows -> {stats['features']} features into {written}")
+    return stats
+
+def load_into_postgis(features: Iterable[Dict], table: str, db_url: Optional[str] = None, mode: str = "expanded",
+                      batch: int = 500, copy_format: str = "text", truncate: bool = False,
+                      rebuild_indexes: bool = False, cluster: bool = False, sync: bool = False,
+                      timings: Optional[Dict[str, float]] = None, stage: str = "load", swap: bool = False,
+                      partition: Optional[str] = None) -> Dict:
+    if swap:
+        return load_via_swap(features, table, db_url=db_url, mode=mode, batch=batch, copy_format=copy_format,
+                             cluster=cluster, timings=timings, stage=stage, partition=partition)
+    conn = get_db_conn(db_url)
+    try:
+        ensure_postgis_and_table(conn, table, mode=mode, partition=partition)
+        if truncate:
+            truncate_table(conn, table)
+        if rebuild_indexes:
+            drop_indexes(conn, table)
         try:
-            execute_values(cur, insert_sql, chunk, template=vals_template)
-            conn.commit()
-            results["inserted"] += len(chunk)
-            results["batches"].append({"index": i//batch_size, "ok": True, "count": len(chunk)})
-        except Exception as e:
-            conn.rollback()
-            results["batches"].append({"index": i//batch_size, "ok": False, "error": str(e)})
-            break
-    cur.close()
-    return results
+            with timed(timings, stage):
+                res = insert_features_bulk(conn, table, features, batch_size=batch,
+                                           copy_format=copy_format, sync=sync)
+        finally:
+            if rebuild_indexes:
+                with timed(timings, "indexes"):
+                    create_indexes(conn, table)
+        if rebuild_indexes or cluster:
+            with timed(timings, "maintenance"):
+                run_maintenance(conn, table, reindex=False, cluster=cluster)
+        print("Insert result:", json.dumps(res, ensure_ascii=False, indent=2))
+    finally:
+        conn.close()
+    return res
 
+def load_via_swap(features: Iterable[Dict], table: str, db_url: Optional[str] = None, mode: str = "expanded",
+                  batch: int = 500, copy_format: str = "text", cluster: bool = False,
+                  timings: Optional[Dict[str, float]] = None, stage: str = "load",
+                  partition: Optional[str] = None) -> Dict:
+    """
+    Full refresh without exposing a partial table: COPY into an UNLOGGED {table}_staging,
+    build its indexes, then rename it over {table} (the old rows stay in {table}_prev).
+    If anything fails before the swap, the live table is untouched.
+    """
+    conn = get_db_conn(db_url)
+    try:
+        staging = prepare_staging_table(conn, table, mode=mode, partition=partition)
+        with timed(timings, stage):
+            res = insert_features_bulk(conn, staging, features, batch_size=batch, copy_format=copy_format,
+                                       bump_version=False)
+        if not res.get("ok"):
+            print(f"Load into {staging} failed, {table} left unchanged")
+            return res
+        with timed(timings, "indexes"):
+            finish_staging_table(conn, staging, cluster=cluster)
+        with timed(timings, "swap"):
+            res["data_version"] = swap_in_staging(conn, table)
+        res["swapped"] = True
+        print("Insert result:", json.dumps(res, ensure_ascii=False, indent=2))
+    finally:
+        conn.close()
+    return res
+
+def iter_with_row_hashes(features: Iterable[Dict], chunk_size: int = 10000) -> Iterator[Dict]:
+    # artifacts written without --sync carry no row_hash
+    seen = Counter()
+    it = iter(features)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        if not chunk[0]["attributes"].get("row_hash"):
+            add_row_hashes(chunk, None, seen)
+        yield from chunk
+
+def check_artifact_mode(path: str, mode: str) -> None:
+    written = artifact_mode(path)
+    if written != mode:
+        # weighted artifacts hold counts, expanded ones 0/1 flags: loading one as the other loses data
+        raise RuntimeError(f"{path} was written with --mode {written}; load it with --mode {written}")
+
+def load_artifact(path: str, table: str, sync: bool = False, chunk_size: int = 10000, **load_args) -> Dict:
+    """Load a parquet/arrow artifact written by --output-format into PostGIS, batch by batch."""
+    check_artifact_mode(path, load_args.get("mode", "expanded"))
+    features = iter_artifact_features(path, batch_size=chunk_size)
+    if sync:
+        features = iter_with_row_hashes(features, chunk_size)
+    return load_into_postgis(features, table, sync=sync, **load_args)
+
+def iso_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a YYYY-MM-DD date, got {value!r}")
 
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument("--input", help="Local CSV input file")
+    p.add_argument("--input", help="Local CSV input file, or a .parquet/.arrow artifact to load into PostGIS as is")
     p.add_argument("--sheet-id", help="Google Sheet ID")
     p.add_argument("--gid", type=int, default=0, help="gid for public download")
     p.add_argument("--download", action="store_true", help="Download public CSV export")
@@ -325,54 +1150,122 @@ def main():
     p.add_argument("--worksheet-name", help="Worksheet name for service account reading (optional)")
     p.add_argument("--table", default="transformed_features", help="Target PostGIS table name")
     p.add_argument("--db-url", help="Postgres connection URL (psycopg2)")
-    p.add_argument("--batch", type=int, default=500, help="Batch size for DB inserts")
+    p.add_argument("--batch", type=int, default=500, help="Progress reporting interval (rows) for DB loads")
+    p.add_argument("--copy-format", choices=["text", "binary"], default="text", help="COPY wire format for DB loads")
     p.add_argument("--dry-run", action="store_true", help="Prepare files but do not write to DB")
     p.add_argument("--output-dir", default="results", help="Dir for prepared JSON/preview CSV")
+    p.add_argument("--output-format", choices=["ndjson", "json"] + list(ARTIFACT_FORMATS), default="ndjson",
+                   help="ndjson: one feature per line ({table}.ndjson); json: legacy indented array ({table}.json); "
+                        "parquet / arrow: one columnar artifact ({table}.parquet / {table}.arrow), no preview CSV")
     p.add_argument("--truncate-before-insert", action="store_true", help="TRUNCATE table before insert")
+    p.add_argument("--mode", choices=["expanded", "weighted"], default="expanded",
+                   help="expanded: one point per value unit; weighted: one row per source record with counts")
+    p.add_argument("--stream", action="store_true", help="Read, transform and load the input in chunks (bounded memory)")
+    p.add_argument("--chunk-size", type=int, default=10000, help="Source rows per chunk in --stream mode")
+    p.add_argument("--workers", type=int, default=1, help="Processes for the transform (implies --stream when > 1)")
+    p.add_argument("--drop-indexes", action="store_true",
+                   help="Drop secondary indexes before the load and rebuild them afterwards (very large loads)")
+    p.add_argument("--maintenance", action="store_true",
+                   help="Only run maintenance on --table (create missing indexes, REINDEX, ANALYZE, rebuild "
+                        "{table}_daily_stats) and exit")
+    p.add_argument("--cluster", action="store_true",
+                   help="CLUSTER the table on its geom index after the load / during --maintenance (exclusive lock)")
+    p.add_argument("--sync", action="store_true",
+                   help="Incremental load keyed on row_hash: insert new rows, delete vanished ones, keep the rest")
+    p.add_argument("--swap", action="store_true",
+                   help="Full refresh via an UNLOGGED {table}_staging swapped in by rename; keeps {table}_prev")
+    p.add_argument("--rollback-swap", action="store_true",
+                   help="Only swap {table} and {table}_prev back (undo the last --swap) and exit")
+    p.add_argument("--partition", choices=PARTITIONINGS,
+                   help="Create the table range-partitioned on d_date by month/year (partitions are added during loads)")
+    p.add_argument("--detach-partitions-before", metavar="YYYY-MM-DD", type=iso_date,
+                   help="Only detach partitions that end on or before this date and exit")
+    p.add_argument("--drop-partitions-before", metavar="YYYY-MM-DD", type=iso_date,
+                   help="Only drop partitions that end on or before this date and exit")
     args = p.parse_args()
+    if args.swap and (args.sync or args.truncate_before_insert or args.drop_indexes):
+        p.error("--swap replaces the whole table; it cannot be combined with --sync, --truncate-before-insert or --drop-indexes")
+    if args.workers > 1:
+        args.stream = True
+
+    if args.detach_partitions_before or args.drop_partitions_before:
+        conn = get_db_conn(args.db_url)
+        try:
+            if args.drop_partitions_before:
+                retire_partitions(conn, args.table, args.drop_partitions_before, drop=True)
+            else:
+                retire_partitions(conn, args.table, args.detach_partitions_before)
+        finally:
+            conn.close()
+        sys.exit(0)
 
+    if args.rollback_swap:
+        conn = get_db_conn(args.db_url)
+        try:
+            rollback_swap(conn, args.table)
+        finally:
+            conn.close()
+        sys.exit(0)
+
+    if args.maintenance:
+        conn = get_db_conn(args.db_url)
+        try:
+            cur = conn.cursor()
+            mode = table_mode(cur, args.table) or args.mode
+            cur.close()
+            ensure_postgis_and_table(conn, args.table, mode=mode)
+            run_maintenance(conn, args.table, reindex=True, cluster=args.cluster)
+            # also (re)builds the summary of tables loaded before it existed
+            cur = conn.cursor()
+            refresh_stats(cur, args.table)
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+        print(f"Maintenance finished for {args.table}")
+        sys.exit(0)
+
+    timings: Dict[str, float] = {}
     tmp_csv = None
+    csv_path = None
+    df = None
     if args.input:
-        df = read_local_csv(args.input)
+        csv_path = args.input
     elif args.sheet_id and args.download:
-        tmp_csv = download_public_csv(args.sheet_id, gid=args.gid, out_path="._download.csv")
-        df = read_local_csv(tmp_csv)
+        with timed(timings, "fetch"):
+            tmp_csv = download_public_csv(args.sheet_id, gid=args.gid, out_path="._download.csv")
+        csv_path = tmp_csv
     elif args.sheet_id and args.service_account:
-        df = read_sheet_via_service_account(args.service_account, args.sheet_id, args.worksheet_name)
+        with timed(timings, "fetch"):
+            df = read_sheet_via_service_account(args.service_account, args.sheet_id, args.worksheet_name)
     else:
         print("Provide --input or (--sheet-id with --download) or (--sheet-id with --service-account)")
         sys.exit(1)
 
-    print(f"Read {len(df)} rows from source")
-
-    features, preview_rows, meta = prepare_features_from_df(df)
-    print(f"Prepared {len(features)} features")
-
-    os.makedirs(args.output_dir, exist_ok=True)
-    json_out = os.path.join(args.output_dir, f"{args.table}.json")
-    preview_out = os.path.join(args.output_dir, f"{args.table}_preview.csv")
-    with open(json_out, "w", encoding="utf-8") as fh:
-        json.dump(features, fh, ensure_ascii=False, indent=2)
-    if preview_rows:
-        pd.DataFrame(preview_rows).to_csv(preview_out, index=False, encoding='utf-8-sig')
-    print(f"Wrote prepared JSON: {json_out}")
-    print(f"Wrote preview CSV: {preview_out}")
-
-    if args.dry_run:
-        print("Dry-run: skipping DB write")
-        if tmp_csv and not args.download:
-            pass
+    if csv_path and is_artifact(csv_path):
+        check_artifact_mode(csv_path, args.mode)
+        if args.dry_run:
+            print("Dry-run: skipping DB write")
+            sys.exit(0)
+        load_artifact(csv_path, args.table, sync=args.sync, chunk_size=args.chunk_size, db_url=args.db_url,
+                      mode=args.mode, batch=args.batch, copy_format=args.copy_format,
+                      truncate=args.truncate_before_insert, rebuild_indexes=args.drop_indexes,
+                      cluster=args.cluster, timings=timings, swap=args.swap, partition=args.partition)
+        print_timings(timings)
         sys.exit(0)
 
-    conn = get_db_conn(args.db_url)
-    try:
-        ensure_postgis_and_table(conn, args.table)
-        if args.truncate_before_insert:
-            truncate_table(conn, args.table)
-        res = insert_features_bulk(conn, args.table, features, batch_size=args.batch)
-        print("Insert result:", json.dumps(res, ensure_ascii=False, indent=2))
-    finally:
-        conn.close()
+    if csv_path and not args.stream:
+        with timed(timings, "read"):
+            df = read_local_csv(csv_path)
+    transform_and_load(
+        df=df, csv_path=csv_path, table=args.table, db_url=args.db_url, mode=args.mode,
+        output_dir=args.output_dir, output_format=args.output_format, batch=args.batch,
+        copy_format=args.copy_format, dry_run=args.dry_run, truncate=args.truncate_before_insert,
+        stream=args.stream, chunk_size=args.chunk_size, workers=args.workers,
+        rebuild_indexes=args.drop_indexes, cluster=args.cluster, sync=args.sync, timings=timings,
+        swap=args.swap, partition=args.partition,
+    )
+    print_timings(timings)
     if tmp_csv and not args.download:
         try:
             os.remove(tmp_csv)
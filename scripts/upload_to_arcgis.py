@@ -1,11 +1,17 @@
 from __future__ import annotations
 import os
 import json
-import time
 import argparse
-from typing import List, Dict, Any, Optional
-from datetime import datetime
-import math
+from typing import List, Dict, Any, Optional, Iterable, Iterator
+import itertools
+
+import numpy as np
+
+from utils.artifacts import is_artifact, iter_artifact_features
+from utils.cleaning import parse_coordinate_column, parse_date_column, date_to_epoch_ms
+from utils.arcgis_rest import (
+    upload_concurrently, sync_features, ThrottledError, PayloadTooLargeError, load_journal, journal_writer,
+)
 
 try:
     from arcgis.gis import GIS
@@ -16,14 +22,22 @@ except Exception as exc:
 
 def parse_args():
     p = argparse.ArgumentParser()
-    p.add_argument("--features", required=True, help="Path to prepared JSON features (features have 'attributes' and 'wkt' or long/lat)")
+    p.add_argument("--features", required=True, help="Path to prepared features: NDJSON (one per line), a .parquet/.arrow artifact or a JSON array (features have 'attributes' and 'wkt' or long/lat)")
     p.add_argument("--item-id", help="ArcGIS item id (portal item with layers). If given, uses item.layers[layer_index]")
     p.add_argument("--layer-index", type=int, default=0, help="Index of layer inside item (default 0)")
     p.add_argument("--feature-layer-url", help="Direct FeatureLayer URL (alternative to --item-id)")
     p.add_argument("--gis-url", default="https://www.arcgis.com", help="Portal/ArcGIS Online URL")
-    p.add_argument("--batch", type=int, default=200, help="Batch size for adds")
-    p.add_argument("--sleep", type=float, default=0.3, help="Seconds to sleep between batches")
+    p.add_argument("--batch", type=int, default=200, help="Initial batch size for adds (adapted to response time)")
+    p.add_argument("--max-batch", type=int, default=2000, help="Upper bound for the adaptive batch size")
+    p.add_argument("--max-in-flight", type=int, default=4, help="Batches sent concurrently")
+    p.add_argument("--retries", type=int, default=5, help="Retries per batch on throttling / connect timeouts")
+    p.add_argument("--sleep", type=float, default=0.0, help="Minimum seconds between batch submissions")
     p.add_argument("--dry-run", action="store_true", help="Do not upload — just print summary and first batch")
+    p.add_argument("--journal", help="Journal of acknowledged batches (default: <features>.journal.jsonl)")
+    p.add_argument("--resume", action="store_true", help="Skip batches already acknowledged in the journal")
+    p.add_argument("--sync", action="store_true",
+                   help="Only add new features and delete vanished ones (applyEdits), matched by --hash-field")
+    p.add_argument("--hash-field", default="row_hash", help="String field of the layer holding the content hash")
     return p.parse_args()
 
 
@@ -41,60 +55,72 @@ def auth_gis(gis_url: str) -> GIS:
     raise RuntimeError("No ArcGIS credentials found. Set ARCGIS_API_KEY or ARCGIS_USERNAME & ARCGIS_PASSWORD.")
 
 
-def load_features(path: str) -> List[Dict[str, Any]]:
+def load_features(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily yield prepared features. NDJSON files are read line by line, .parquet/.arrow
+    artifacts record batch by record batch (memory-mapped); a legacy JSON array
+    (first non-blank char '[') still has to be loaded as a whole.
+    """
+    if is_artifact(path):
+        yield from iter_artifact_features(path)
+        return
     with open(path, "r", encoding="utf-8") as fh:
-        data = json.load(fh)
-    if not isinstance(data, list):
-        raise RuntimeError("Features JSON must be a list of features")
-    return data
-
-
-def convert_to_arcgis_features(features: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-
-    out = []
-    for f in features:
-        attrs = dict(f.get("attributes", {}))
-        lon = attrs.get("long")
-        lat = attrs.get("lat")
-        if lon is None or lat is None:
-            # try parse WKT
-            wkt = f.get("wkt") or f.get("geometry_wkt")
-            if wkt and wkt.upper().startswith("POINT"):
-                try:
-                    inner = wkt[wkt.find("(") + 1 : wkt.find(")")]
-                    parts = inner.strip().split()
-                    lon = float(parts[0])
-                    lat = float(parts[1])
-                except Exception:
-                    lon = lat = None
+        head = next((line.lstrip()[:1] for line in fh if line.strip()), "")
+        fh.seek(0)
+        if head == "[":
+            data = json.load(fh)
+            if not isinstance(data, list):
+                raise RuntimeError("Features JSON must be a list of features")
+            yield from data
+            return
+        if head not in ("{", ""):
+            raise RuntimeError("Features file must be NDJSON (one feature object per line) or a JSON array")
+        for line in fh:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def wkt_point(wkt: Optional[str]):
+    if wkt and wkt.upper().startswith("POINT"):
         try:
-            lon = float(lon) if lon is not None and str(lon) != "" else None
-            lat = float(lat) if lat is not None and str(lat) != "" else None
+            inner = wkt[wkt.find("(") + 1 : wkt.find(")")]
+            parts = inner.strip().split()
+            return parts[0], parts[1]
         except Exception:
-            lon = lat = None
-
-        d_date = attrs.get("d_date")
-        if d_date:
-            if isinstance(d_date, str):
-
-                for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y/%m/%d"):
-                    try:
-                        dt = datetime.strptime(d_date, fmt)
-                        epoch_ms = int(dt.timestamp() * 1000)
-                        attrs["d_date"] = epoch_ms
-                        break
-                    except Exception:
-                        continue
-
-        geometry = None
-        if lon is not None and lat is not None and not (math.isnan(lon) or math.isnan(lat)):
-            geometry = {"x": lon, "y": lat, "spatialReference": {"wkid": 4326}}
-        else:
-            print("Skipping feature with missing geometry:", attrs)
-            continue
+            pass
+    return None, None
+
 
-        out.append({"attributes": attrs, "geometry": geometry})
-    return out
+def convert_to_arcgis_features(features: Iterable[Dict[str, Any]], chunk_size: int = 10000) -> Iterator[Dict[str, Any]]:
+    # coordinates and dates are parsed a chunk (column) at a time with utils.cleaning
+    for chunk in iter_batches(features, chunk_size):
+        attrs_list = [dict(f.get("attributes", {})) for f in chunk]
+        lons, lats = [], []
+        for f, attrs in zip(chunk, attrs_list):
+            lon, lat = attrs.get("long"), attrs.get("lat")
+            if lon is None or lat is None:
+                lon, lat = wkt_point(f.get("wkt") or f.get("geometry_wkt"))
+            lons.append(lon)
+            lats.append(lat)
+        x, x_ok = parse_coordinate_column(np.array(lons, dtype=object), "lon")
+        y, y_ok = parse_coordinate_column(np.array(lats, dtype=object), "lat")
+
+        raw_dates = [a.get("d_date") for a in attrs_list]
+        str_idx = [i for i, d in enumerate(raw_dates) if d and isinstance(d, str)]
+        iso = parse_date_column(np.array([raw_dates[i] for i in str_idx], dtype=object))
+        epoch = {}
+        for i, d in zip(str_idx, iso):
+            if d not in epoch:
+                epoch[d] = date_to_epoch_ms(d)
+            if epoch[d] is not None:
+                attrs_list[i]["d_date"] = epoch[d]
+
+        for attrs, lon, lat, ok in zip(attrs_list, x.tolist(), y.tolist(), (x_ok & y_ok).tolist()):
+            if not ok:
+                print("Skipping feature with missing geometry:", attrs)
+                continue
+            yield {"attributes": attrs, "geometry": {"x": lon, "y": lat, "spatialReference": {"wkid": 4326}}}
 
 
 def get_feature_layer(gis: GIS, item_id: Optional[str], layer_index: int, feature_layer_url: Optional[str]) -> FeatureLayer:
@@ -115,27 +141,111 @@ def get_feature_layer(gis: GIS, item_id: Optional[str], layer_index: int, featur
     raise RuntimeError("Either item_id or feature_layer_url must be provided")
 
 
-def upload_batches(fl: FeatureLayer, arcgis_features: List[Dict[str, Any]], batch: int, sleep_between: float, dry_run: bool = False):
-    total = len(arcgis_features)
-    print(f"Uploading {total} features in batches of {batch} ... dry_run={dry_run}")
-    results = {"batches": [], "total": total}
-    for i in range(0, total, batch):
-        chunk = arcgis_features[i:i+batch]
-        if dry_run:
-            print(f"[dry-run] batch {i//batch} size {len(chunk)} preview element:", chunk[0] if chunk else None)
-            results["batches"].append({"index": i//batch, "ok": True, "count": len(chunk), "dry_run": True})
-            continue
+def iter_batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
-        try:
-            resp = fl.edit_features(adds=chunk)
-            results["batches"].append({"index": i//batch, "ok": True, "count": len(chunk), "response": resp})
-            print(f"Batch {i//batch} uploaded, response summary keys: {list(resp.keys()) if isinstance(resp, dict) else type(resp)}")
-        except Exception as e:
-            print(f"Error uploading batch {i//batch}: {e}")
-            results["batches"].append({"index": i//batch, "ok": False, "error": str(e)})
-            break
-        time.sleep(sleep_between)
-    return results
+
+def edit_features_classified(fl: FeatureLayer, **edits) -> Dict[str, Any]:
+    # the arcgis package raises plain exceptions; map throttling / size errors for the uploader's retry logic
+    try:
+        return fl.edit_features(**edits)
+    except Exception as e:
+        msg = str(e).lower()
+        if "429" in msg or "too many requests" in msg or "throttl" in msg or "503" in msg:
+            raise ThrottledError(str(e)) from e
+        if "413" in msg or "too large" in msg or "exceeds" in msg:
+            raise PayloadTooLargeError(str(e)) from e
+        raise
+
+
+def upload_fingerprint(features_path: str, target: str) -> Dict[str, Any]:
+    # journal offsets are only valid for the exact same features file and layer
+    st = os.stat(features_path)
+    return {"features": os.path.abspath(features_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "target": target}
+
+
+def upload_batches(fl: FeatureLayer, arcgis_features: Iterable[Dict[str, Any]], batch: int, sleep_between: float,
+                   dry_run: bool = False, max_batch: int = 2000, max_in_flight: int = 4, retries: int = 5,
+                   journal: Optional[str] = None, fingerprint: Optional[Dict[str, Any]] = None, resume: bool = False):
+    print(f"Uploading features in batches of {batch} (adaptive up to {max_batch}, {max_in_flight} in flight) ... dry_run={dry_run}")
+    if dry_run:
+        results = {"batches": [], "total": 0}
+        for n, chunk in enumerate(iter_batches(arcgis_features, batch)):
+            results["total"] += len(chunk)
+            print(f"[dry-run] batch {n} size {len(chunk)} preview element:", chunk[0] if chunk else None)
+            results["batches"].append({"index": n, "ok": True, "count": len(chunk), "dry_run": True})
+        return results
+
+    def report(entry: Dict[str, Any], chunk: List[Dict[str, Any]]):
+        if entry["ok"]:
+            print(f"Batch @{entry['start']} ({entry['count']} features) uploaded in {entry['seconds']}s, "
+                  f"retries={entry['retries']}, failed={entry['failed']}")
+        else:
+            print(f"Error uploading batch @{entry['start']} ({entry['count']} features): {entry['error']}")
+
+    done = []
+    if journal:
+        done = load_journal(journal, fingerprint) if resume else []
+        if done:
+            acknowledged = len({o for start, count in done for o in range(start, start + count)})
+            print(f"Resuming: {acknowledged} features already acknowledged ({journal})")
+        write = journal_writer(journal, fingerprint, resume=resume)
+
+        def on_batch(entry: Dict[str, Any], chunk: List[Dict[str, Any]]):
+            write(entry, chunk)
+            report(entry, chunk)
+    else:
+        on_batch = report
+
+    return upload_concurrently(
+        lambda chunk: edit_features_classified(fl, adds=chunk),
+        arcgis_features,
+        batch_size=batch,
+        max_batch_size=max_batch,
+        max_in_flight=max_in_flight,
+        max_retries=retries,
+        min_interval=sleep_between,
+        on_batch=on_batch,
+        skip_ranges=done,
+    )
+
+
+def existing_hashes(fl: FeatureLayer, hash_field: str) -> Dict[Any, List[Any]]:
+    oid_field = fl.properties.get("objectIdField") or "OBJECTID"
+    # return_all_records pages with resultOffset, which is only stable with an explicit order
+    fs = fl.query(where="1=1", out_fields=f"{oid_field},{hash_field}", return_geometry=False,
+                  return_all_records=True, order_by_fields=oid_field)
+    oid_field = fs.object_id_field_name or oid_field
+    existing: Dict[Any, List[Any]] = {}
+    for f in fs.features:
+        existing.setdefault(f.attributes.get(hash_field), []).append(f.attributes.get(oid_field))
+    return existing
+
+
+def sync_layer(fl: FeatureLayer, arcgis_features: Iterable[Dict[str, Any]], hash_field: str, batch: int,
+               sleep_between: float, max_batch: int = 2000, max_in_flight: int = 4, retries: int = 5):
+    existing = existing_hashes(fl, hash_field)
+    print(f"Sync: layer has {sum(len(v) for v in existing.values())} features with {len(existing)} distinct {hash_field}")
+    res = sync_features(
+        lambda chunk: edit_features_classified(fl, adds=chunk),
+        lambda oids: edit_features_classified(fl, deletes=",".join(str(oid) for oid in oids)),
+        arcgis_features,
+        existing,
+        hash_field=hash_field,
+        batch_size=batch,
+        max_batch_size=max_batch,
+        max_in_flight=max_in_flight,
+        max_retries=retries,
+        min_interval=sleep_between,
+    )
+    print(f"Sync: added {res['adds']['total']}, unchanged {res['unchanged']}, "
+          f"deleted {res.get('deletes', {}).get('total', 0)} of {res['to_delete']}")
+    return res
 
 
 def main():
@@ -143,14 +253,26 @@ def main():
     gis = auth_gis(args.gis_url)
     raw = load_features(args.features)
     arcgis_feats = convert_to_arcgis_features(raw)
-    if not arcgis_feats:
+    first = next(arcgis_feats, None)
+    if first is None:
         print("No features to upload after conversion.")
         return
+    arcgis_feats = itertools.chain([first], arcgis_feats)
 
     fl = get_feature_layer(gis, args.item_id, args.layer_index, args.feature_layer_url)
 
-    print("Preview attributes sample:", arcgis_feats[0]["attributes"])
-    res = upload_batches(fl, arcgis_feats, batch=args.batch, sleep_between=args.sleep, dry_run=args.dry_run)
+    print("Preview attributes sample:", first["attributes"])
+    if args.sync and not args.dry_run:
+        res = sync_layer(fl, arcgis_feats, args.hash_field, batch=args.batch, sleep_between=args.sleep,
+                         max_batch=args.max_batch, max_in_flight=args.max_in_flight, retries=args.retries)
+        print("Sync summary:", json.dumps(res, ensure_ascii=False, indent=2, default=str))
+        return
+
+    journal = args.journal or f"{args.features}.journal.jsonl"
+    target = args.feature_layer_url or f"{args.item_id}/{args.layer_index}"
+    res = upload_batches(fl, arcgis_feats, batch=args.batch, sleep_between=args.sleep, dry_run=args.dry_run,
+                         max_batch=args.max_batch, max_in_flight=args.max_in_flight, retries=args.retries,
+                         journal=journal, fingerprint=upload_fingerprint(args.features, target), resume=args.resume)
     print("Upload summary:", json.dumps(res, ensure_ascii=False, indent=2, default=str))
 
 
@@ -0,0 +1,135 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+
+class FeatureServer:
+    """
+    Local stand-in for an ArcGIS FeatureServer layer: the layer description, addFeatures,
+    applyEdits (adds / deletes) and query with resultOffset paging of at most max_record_count.
+    Like a real server it only keeps pages in a stable order when orderByFields is given.
+    Features whose attributes have "reject": true get success: false in addResults,
+    every throttle_every-th call answers 429 and calls listed in fail_calls answer 500.
+    Calls listed in slow_calls are applied and then answered only after slow_seconds.
+    """
+
+    oid_field = "FID"
+    max_record_count = 50
+
+    def __init__(self):
+        self.features = {}
+        self.next_oid = 1
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.throttle_every = 0
+        self.fail_calls = set()
+        self.slow_calls = set()
+        self.slow_seconds = 1.0
+        self.lock = threading.Lock()
+
+    def add(self, features):
+        results = []
+        for f in features:
+            if f["attributes"].get("reject"):
+                results.append({"objectId": None, "success": False,
+                                "error": {"code": 1000, "description": "rejected"}})
+                continue
+            oid = self.next_oid
+            self.next_oid += 1
+            self.features[oid] = f
+            results.append({"objectId": oid, "success": True})
+        return {"addResults": results}
+
+    def delete(self, oids):
+        results = []
+        for oid in oids:
+            ok = self.features.pop(oid, None) is not None
+            results.append({"objectId": oid, "success": ok})
+        return {"deleteResults": results}
+
+    def query(self, form):
+        oids = sorted(self.features)
+        if form.get("orderByFields") != self.oid_field:
+            random.shuffle(oids)
+        offset = int(form.get("resultOffset", 0))
+        count = min(int(form.get("resultRecordCount", self.max_record_count)), self.max_record_count)
+        page = oids[offset:offset + count]
+        fields = form.get("outFields", "*").split(",")
+        features = []
+        for oid in page:
+            attrs = dict(self.features[oid]["attributes"], **{self.oid_field: oid})
+            features.append({"attributes": {k: v for k, v in attrs.items() if "*" in fields or k in fields}})
+        return {"objectIdFieldName": self.oid_field, "features": features,
+                "exceededTransferLimit": offset + count < len(oids)}
+
+    def handle(self, path, form):
+        with self.lock:
+            if path.endswith("/addFeatures"):
+                return 200, self.add(json.loads(form["features"]))
+            if path.endswith("/applyEdits"):
+                body = {"addResults": [], "updateResults": [], "deleteResults": []}
+                if form.get("adds"):
+                    body.update(self.add(json.loads(form["adds"])))
+                if form.get("deletes"):
+                    body.update(self.delete(int(oid) for oid in form["deletes"].split(",")))
+                return 200, body
+            if path.endswith("/query"):
+                return 200, self.query(form)
+            if path.endswith("/FeatureServer/0"):
+                return 200, {"objectIdField": self.oid_field, "maxRecordCount": self.max_record_count,
+                             "fields": [{"name": self.oid_field, "type": "esriFieldTypeOID"}]}
+        return 200, {"error": {"code": 400, "message": f"unsupported operation {path}"}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        state = self.server.state
+        raw = self.rfile.read(int(self.headers["Content-Length"]))
+        form = {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+        with state.lock:
+            state.calls += 1
+            call = state.calls
+            state.in_flight += 1
+            state.max_in_flight = max(state.max_in_flight, state.in_flight)
+        try:
+            if state.throttle_every and call % state.throttle_every == 0:
+                return self.reply(429, {})
+            if call in state.fail_calls:
+                return self.reply(500, {})
+            reply = state.handle(self.path.split("?")[0], form)
+            if call in state.slow_calls:
+                time.sleep(state.slow_seconds)
+            self.reply(*reply)
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+
+@pytest.fixture
+def feature_server():
+    """(FeatureServer state, layer URL) of a stand-in served on a free local port."""
+    state = FeatureServer()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield state, f"http://127.0.0.1:{server.server_address[1]}/arcgis/rest/services/test/FeatureServer/0"
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,36 @@
+from collections import Counter
+
+from utils.arcgis_rest import make_session, query_feature_hashes, sync_features_via_rest
+
+
+def make_features(ns):
+    return [{"attributes": {"n": n}, "geometry": {"x": 30.0, "y": 50.0 + n / 1000}} for n in ns]
+
+
+def stored_counts(state):
+    return Counter(f["attributes"]["n"] for f in state.features.values())
+
+
+def test_query_feature_hashes_sees_every_feature_once(feature_server):
+    state, url = feature_server
+    for i in range(237):
+        state.add([{"attributes": {"row_hash": f"h{i}"}}])
+    existing = query_feature_hashes(make_session(1), url, "row_hash", page_size=2000)
+    assert existing == {f"h{i}": [i + 1] for i in range(237)}
+
+
+def test_sync_keeps_unchanged_features(feature_server):
+    state, url = feature_server
+    first = sync_features_via_rest(make_features(range(300)), url, batch_size=40, backoff=0.01)
+    assert first["success"] and first["to_delete"] == 0
+    oids = {f["attributes"]["n"]: oid for oid, f in state.features.items()}
+
+    # drop 0..9, add 300..309: only those twenty features may change
+    second = sync_features_via_rest(make_features(range(10, 310)), url, batch_size=40, backoff=0.01)
+    assert second["success"]
+    assert second["unchanged"] == 290
+    assert second["to_delete"] == 10
+    assert second["adds"]["total"] == 10
+    assert stored_counts(state) == Counter(range(10, 310))
+    assert all(state.features[oids[n]]["attributes"]["n"] == n for n in range(10, 300))
+
@@ -0,0 +1,63 @@
+from collections import Counter
+
+from utils.arcgis_rest import journal_writer, load_journal, upload_features_via_rest
+
+FINGERPRINT = {"features": "test.ndjson", "target": "layer"}
+
+
+def make_features(n, reject=()):
+    return [{"attributes": {"n": i, "reject": i in reject}, "geometry": {"x": 30.0, "y": 50.0}} for i in range(n)]
+
+
+def stored_counts(state):
+    return Counter(f["attributes"]["n"] for f in state.features.values())
+
+
+def test_upload_survives_throttling(feature_server):
+    state, url = feature_server
+    state.throttle_every = 5
+    res = upload_features_via_rest(make_features(1000), url, batch_size=50, max_in_flight=3, backoff=0.01)
+    assert res["success"]
+    assert stored_counts(state) == Counter(range(1000))
+    assert state.max_in_flight <= 3
+
+
+def test_resume_resends_failed_batches_and_rejected_features(feature_server, tmp_path):
+    state, url = feature_server
+    journal = str(tmp_path / "upload.journal.jsonl")
+
+    # first run: one batch fails outright, two features are rejected inside acknowledged batches
+    state.fail_calls = {3}
+    res = upload_features_via_rest(make_features(500, reject={7, 321}), url, batch_size=50, max_batch_size=50,
+                                   max_in_flight=1, on_batch=journal_writer(journal, FINGERPRINT))
+    assert not res["success"]
+    assert res["failed_features"] == 2
+    first = stored_counts(state)
+    assert 7 not in first and 321 not in first
+    assert len(first) == 500 - 50 - 2
+
+    done = load_journal(journal, FINGERPRINT)
+    acknowledged = {o for start, count in done for o in range(start, start + count)}
+    assert 7 not in acknowledged and 321 not in acknowledged
+
+    # resumed run: only the failed batch and the rejected features are sent again
+    state.fail_calls = set()
+    calls = state.calls
+    res = upload_features_via_rest(make_features(500), url, batch_size=50, max_batch_size=50, max_in_flight=1,
+                                   on_batch=journal_writer(journal, FINGERPRINT, resume=True), skip_ranges=done)
+    assert res["success"]
+    assert res["total"] == 52
+    assert stored_counts(state) == Counter(range(500))
+    assert load_journal(journal, FINGERPRINT) and state.calls - calls == 3
+
+
+def test_read_timeout_is_not_retried(feature_server):
+    state, url = feature_server
+    # call 2 adds its batch, but the reply comes after the client gave up
+    state.slow_calls = {2}
+    state.slow_seconds = 1.0
+    res = upload_features_via_rest(make_features(100), url, batch_size=20, max_in_flight=1, backoff=0.01,
+                                   timeout=0.3, max_batch_size=20)
+    failed = [b for b in res["batches"] if not b["ok"]]
+    assert len(failed) == 1 and failed[0]["start"] == 20
+    assert stored_counts(state) == Counter(range(100))
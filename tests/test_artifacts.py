@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from scripts.transform_to_postgis import load_artifact
+from utils.artifacts import artifact_mode, artifact_schema, iter_artifact_features, write_artifact
+from utils.fields import VALUE_FIELDS
+
+
+def make_features(counts):
+    return [{"attributes": dict({"d_date": "2024-03-05", "t_region": "R", "t_city": "C", "long": 30.0, "lat": 50.0},
+                                **dict(zip(VALUE_FIELDS, c)))} for c in counts]
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "arrow"])
+@pytest.mark.parametrize("mode", ["expanded", "weighted"])
+def test_artifact_records_its_mode(tmp_path, fmt, mode):
+    path = str(tmp_path / f"t.{fmt}")
+    write_artifact(path, fmt, make_features([[1] * 10]), mode=mode)
+    assert artifact_mode(path) == mode
+
+
+def test_weighted_counts_survive_the_round_trip(tmp_path):
+    path = str(tmp_path / "t.parquet")
+    write_artifact(path, "parquet", make_features([[300] + [0] * 9]), mode="weighted")
+    assert next(iter_artifact_features(path))["attributes"]["i_value_1"] == 300
+
+
+def test_mode_without_metadata_comes_from_the_value_type(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = str(tmp_path / "old.parquet")
+    pq.write_table(pa.table({c: pa.array([1], type=pa.int32()) for c in VALUE_FIELDS}), path)
+    assert artifact_mode(path) == "weighted"
+    assert artifact_schema("expanded").metadata == {b"mode": b"expanded"}
+
+
+def test_load_refuses_the_other_mode(tmp_path):
+    path = str(tmp_path / "t.parquet")
+    write_artifact(path, "parquet", make_features([[3] + [0] * 9]), mode="weighted")
+    # refused before any database connection is made
+    with pytest.raises(RuntimeError, match="--mode weighted"):
+        load_artifact(path, "t", mode="expanded")
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from utils.cleaning import parse_date_column, parse_date_value
+
+
+def column(*values):
+    return parse_date_column(np.array(values, dtype=object)).tolist()
+
+
+def test_iso_dates_keep_month_and_day():
+    # the old per-value dayfirst parse stored 2024-03-05 as 2024-05-03
+    assert column("2024-03-05", "2024-03-06", "2024-03-31") == ["2024-03-05", "2024-03-06", "2024-03-31"]
+
+
+def test_day_first_dates():
+    assert column("05.03.2024", "31.03.2024", "01.04.2024") == ["2024-03-05", "2024-03-31", "2024-04-01"]
+    assert column("05/03/2024", "13/03/2024") == ["2024-03-05", "2024-03-13"]
+
+
+def test_values_outside_the_detected_format():
+    # ISO is the column format; the dd.mm value and the ISO outlier go through the fallback
+    assert column("2024-03-05", "2024-03-06", "07.03.2024") == ["2024-03-05", "2024-03-06", "2024-03-07"]
+    assert column("05.03.2024", "06.03.2024", "2024-03-07") == ["2024-03-05", "2024-03-06", "2024-03-07"]
+
+
+def test_blanks_and_garbage():
+    assert column("05.03.2024", "", None, "  ", "not a date") == ["2024-03-05", None, None, None, "not a date"]
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("2024-03-05", "2024-03-05"),
+    ("05.03.2024", "2024-03-05"),
+    ("", None),
+    ("not a date", "not a date"),
+])
+def test_parse_date_value(raw, expected):
+    assert parse_date_value(raw) == expected
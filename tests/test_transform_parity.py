@@ -0,0 +1,156 @@
+"""
+The vectorized transform must produce exactly the features of the original row-by-row
+implementation, frozen below as old_prepare_features_from_df.
+"""
+
+import os
+import re
+
+import pandas as pd
+import pytest
+
+from scripts.transform_to_postgis import (
+    detect_value_columns,
+    find_col_like,
+    prepare_features_from_df,
+    read_local_csv,
+)
+from utils.cleaning import sheet_values_to_df
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def old_normalize_number_str(s):
+    if s is None:
+        return None
+    if isinstance(s, (int, float)):
+        return s
+    s = str(s).strip()
+    if s == "":
+        return None
+    s = s.replace("\u00A0", "")
+    s = s.replace(" ", "")
+    s = s.replace("'", "").replace("’", "").replace("`", "")
+    s = s.replace(",", ".")
+    try:
+        if re.search(r"[.eE]", s):
+            return float(s)
+        return int(s)
+    except Exception:
+        try:
+            return float(s)
+        except Exception:
+            return None
+
+
+def old_prepare_features_from_df(df: pd.DataFrame):
+    # the iterrows implementation the transform shipped with, kept as the reference
+    cols = [str(c).strip() for c in df.columns]
+    df.columns = cols
+
+    date_col = find_col_like(cols, ["Дата", "date", "d_date", "Date"])
+    region_col = find_col_like(cols, ["Область", "region", "t_region", "Region"])
+    city_col = find_col_like(cols, ["Місто", "city", "t_city", "City"])
+    lon_col = find_col_like(cols, ["long", "longitude", "lon", "Long", "Longitude"])
+    lat_col = find_col_like(cols, ["lat", "latitude", "Lat", "LAT", "Latitude"])
+    value_cols = detect_value_columns(cols)
+
+    features = []
+    preview_rows = []
+    for _, row in df.iterrows():
+        counts = []
+        for c in value_cols:
+            num = old_normalize_number_str(row.get(c, None))
+            if num is None:
+                n = 0
+            else:
+                try:
+                    n = int(float(num))
+                except Exception:
+                    n = 0
+            counts.append(max(0, n))
+        max_n = max(counts) if counts else 0
+        if max_n == 0:
+            continue
+
+        try:
+            x = float(old_normalize_number_str(row.get(lon_col, None)))
+            y = float(old_normalize_number_str(row.get(lat_col, None)))
+        except Exception:
+            continue
+
+        d_raw = row.get(date_col, None)
+        d_date = None
+        if d_raw is not None and str(d_raw).strip() != "":
+            try:
+                d_date = pd.to_datetime(d_raw, dayfirst=True, errors='coerce')
+                if pd.isna(d_date):
+                    d_date = str(d_raw)
+                else:
+                    d_date = d_date.strftime("%Y-%m-%d")
+            except Exception:
+                d_date = str(d_raw)
+
+        for i in range(max_n):
+            attrs = {
+                "d_date": d_date,
+                "t_region": row.get(region_col),
+                "t_city": row.get(city_col),
+                "long": x,
+                "lat": y,
+            }
+            for k in range(len(counts)):
+                attrs[f"i_value_{k+1}"] = 1 if counts[k] > i else 0
+            features.append({"attributes": attrs, "wkt": f"POINT({x} {y})"})
+            preview_rows.append(attrs.copy())
+    return features, preview_rows
+
+
+def assert_parity(df: pd.DataFrame):
+    old_features, old_preview = old_prepare_features_from_df(df.copy())
+    features, preview, _ = prepare_features_from_df(df.copy())
+    assert features == old_features
+    assert preview == old_preview
+    return features
+
+
+def test_parity_on_main_data():
+    df = read_local_csv(os.path.join(DATA_DIR, "main_data.csv"))
+    features = assert_parity(df)
+    assert len(features) > len(df) / 2
+
+
+HEADER = ["Дата", "Область", "Місто"] + [f"Значення {k}" for k in range(1, 11)] + ["long", "lat"]
+
+
+@pytest.mark.parametrize("values, lon, lat", [
+    (["1,5", "0", "", "", "", "", "", "", "", ""], "30,7306393", "46,4702111"),   # decimal commas
+    (["1e1", "2", "0", "0", "0", "0", "0", "0", "0", "0"], "30.5", "46.5"),        # exponent
+    (["", " ", "", "", "", "", "", "", "", ""], "30.5", "46.5"),                    # blanks: no points
+    (["-3", "2", "0", "0", "0", "0", "0", "0", "0", "0"], "-30,5", "-46,25"),     # negatives
+    (["1 000", "abc", "0", "0", "0", "0", "0", "0", "0", "3"], "30.5", "46.5"),   # thousands / junk
+    (["2", "0", "0", "0", "0", "0", "0", "0", "0", "0"], "", "46.5"),              # no coordinate
+    (["2", "0", "0", "0", "0", "0", "0", "0", "0", "0"], "30 .5", "n/a"),     # bad coordinate
+])
+def test_parity_on_edge_cells(values, lon, lat):
+    rows = [
+        ["31.03.2024", "Одеська", "Одеса"] + values + [lon, lat],
+        ["", "Київська", ""] + values + [lon, lat],
+        ["not a date", "Львівська", "Львів"] + values + [lon, lat],
+    ]
+    assert_parity(pd.DataFrame(rows, columns=HEADER, dtype=str))
+
+
+def test_sheet_and_csv_export_load_the_same(tmp_path):
+    # blank t_city / t_region cells: read_csv gives NaN, so the sheet path must not keep ""
+    rows = [
+        HEADER,
+        ["31.03.2024", "Одеська", ""] + ["2"] + ["0"] * 9 + ["30,7306393", "46,4702111"],
+        ["01.04.2024", "", "Люботин"] + ["1"] * 10 + ["35,9407539", "49,9511113"],
+    ]
+    path = tmp_path / "export.csv"
+    pd.DataFrame(rows[1:], columns=rows[0]).to_csv(path, index=False)
+    from_csv, _, _ = prepare_features_from_df(read_local_csv(str(path)))
+    from_sheet, _, _ = prepare_features_from_df(sheet_values_to_df(rows))
+    assert from_sheet == from_csv
+    assert pd.isna(from_sheet[0]["attributes"]["t_city"])
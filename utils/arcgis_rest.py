@@ -1,41 +1,449 @@
+import hashlib
 import json
+import os
+import random
 import time
+import itertools
 import requests
-from typing import List, Dict, Optional
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+THROTTLE_CODES = {429, 503}
+PAYLOAD_CODES = {413}
+
+
+class ThrottledError(Exception):
+    """Service asked us to slow down (HTTP 429/503 or an equivalent JSON error)."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PayloadTooLargeError(Exception):
+    """Request body rejected as too large; the batch has to be split."""
+
+
+def make_session(pool_size: int = 8) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept"] = "application/json"
+    return session
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def check_response(resp: requests.Response) -> Dict:
+    """Raise ThrottledError / PayloadTooLargeError / RuntimeError for failed calls, return the JSON otherwise."""
+    if resp.status_code in THROTTLE_CODES:
+        raise ThrottledError(f"HTTP {resp.status_code}", parse_retry_after(resp.headers.get("Retry-After")))
+    if resp.status_code in PAYLOAD_CODES:
+        raise PayloadTooLargeError(f"HTTP {resp.status_code}")
+    resp.raise_for_status()
+    j = resp.json()
+    # ArcGIS reports most failures as HTTP 200 with {"error": {"code": ..., "message": ...}}
+    err = j.get("error") if isinstance(j, dict) else None
+    if err:
+        code = err.get("code")
+        message = f"{code}: {err.get('message')} {err.get('details') or ''}".strip()
+        if code in THROTTLE_CODES:
+            raise ThrottledError(message)
+        if code in PAYLOAD_CODES:
+            raise PayloadTooLargeError(message)
+        raise RuntimeError(message)
+    return j
 
-def upload_features_via_rest(
-    features: List[Dict],
-    feature_layer_url: str,
-    token: Optional[str] = None,
-    batch_size: int = 200,
-    sleep_between_batches: float = 0.5,
-    timeout: int = 60,
-) -> Dict:
 
+def post_form(session: requests.Session, url: str, payload: Dict, token: Optional[str] = None, timeout: int = 60) -> Dict:
+    data = dict(payload, f="json")
+    if token:
+        data["token"] = token
+    return check_response(session.post(url, data=data, timeout=timeout))
+
+
+def add_features(session: requests.Session, feature_layer_url: str, chunk: List[Dict],
+                 token: Optional[str] = None, timeout: int = 60) -> Dict:
     url = feature_layer_url.rstrip("/") + "/addFeatures"
-    headers = {"Accept": "application/json"}
-    results = {"success": True, "batches": []}
-
-    for i in range(0, len(features), batch_size):
-        chunk = features[i : i + batch_size]
-        payload = {
-            "f": "json",
-            "features": json.dumps(chunk, ensure_ascii=False),
-        }
-        if token:
-            payload["token"] = token
+    return post_form(session, url, {"features": json.dumps(chunk, ensure_ascii=False)}, token, timeout)
+
+
+def edit_result_failures(resp: Any) -> int:
+    if not isinstance(resp, dict):
+        return 0
+    return sum(
+        1
+        for key in ("addResults", "updateResults", "deleteResults")
+        for r in resp.get(key) or []
+        if not r.get("success", True)
+    )
+
 
+def send_with_retry(send: Callable[[List[Dict]], Any], chunk: List[Dict],
+                    max_retries: int, backoff: float) -> Tuple[Any, float, int]:
+    """
+    Call send(chunk), retrying throttling and connect timeouts with exponential backoff and jitter.
+    Adds are not idempotent: after a read timeout or a dropped connection the server may already
+    have applied the batch, so those errors fail the batch for --resume / --sync to reconcile.
+    """
+    for attempt in itertools.count():
+        started = time.monotonic()
         try:
-            resp = requests.post(url, data=payload, headers=headers, timeout=timeout)
-            resp.raise_for_status()
-            j = resp.json()
-        except Exception as e:
+            return send(chunk), time.monotonic() - started, attempt
+        except (ThrottledError, requests.ConnectTimeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = getattr(e, "retry_after", None) or backoff * 2 ** attempt
+            time.sleep(delay * random.uniform(1.0, 1.5))
+
+
+def upload_concurrently(
+    send: Callable[[List[Dict]], Any],
+    features: Iterable[Dict],
+    batch_size: int = 200,
+    min_batch_size: int = 10,
+    max_batch_size: int = 2000,
+    max_in_flight: int = 4,
+    target_seconds: float = 5.0,
+    max_payload_bytes: int = 8 * 1024 * 1024,
+    max_retries: int = 5,
+    backoff: float = 1.0,
+    min_interval: float = 0.0,
+    on_batch: Optional[Callable[[Dict, List[Dict]], None]] = None,
+    skip_ranges: Iterable[Tuple[int, int]] = (),
+) -> Dict:
+    """
+    Push features with send(chunk) keeping up to max_in_flight batches in flight.
+
+    The batch size grows while batches finish well under target_seconds and halves when
+    they are slower or hit max_payload_bytes / a "payload too large" reply (that batch is
+    split and resent). A failed batch is recorded and the upload goes on with the rest.
+    Every batch result carries `start` (offset of its first feature) and `count`;
+    on_batch(result, chunk) is called for each finished batch in completion order.
+    Features covered by skip_ranges ((start, count) pairs, e.g. from a journal) are not sent.
+    """
+    skip = sorted(skip_ranges)
+    it = iter(features)
+    offset = 0
+    retry_queue: deque = deque()
+    size = max(min_batch_size, min(batch_size, max_batch_size))
+    results: Dict[str, Any] = {"success": True, "batches": [], "total": 0, "failed_features": 0}
+
+    def next_chunk() -> Optional[Tuple[int, List[Dict]]]:
+        nonlocal offset, size
+        if retry_queue:
+            return retry_queue.popleft()
+        # skip already acknowledged ranges; a batch is always a contiguous run of offsets
+        while skip and skip[0][0] <= offset:
+            s_start, s_count = skip.pop(0)
+            if s_start + s_count > offset:
+                for _ in itertools.islice(it, s_start + s_count - offset):
+                    offset += 1
+        limit = size if not skip else min(size, skip[0][0] - offset)
+        chunk = list(itertools.islice(it, limit))
+        if not chunk:
+            return None
+        start = offset
+        offset += len(chunk)
+        # keep the form body under the service limit; oversized tails go back to the queue
+        while len(chunk) > 1 and len(json.dumps(chunk, ensure_ascii=False).encode("utf-8")) > max_payload_bytes:
+            half = len(chunk) // 2
+            retry_queue.appendleft((start + half, chunk[half:]))
+            chunk = chunk[:half]
+            size = max(min_batch_size, half)
+        return start, chunk
+
+    def finish(entry: Dict, chunk: List[Dict]) -> None:
+        results["batches"].append(entry)
+        if not entry["ok"]:
             results["success"] = False
-            results["batches"].append({"index": i // batch_size, "ok": False, "error": str(e)})
-            break
+        if on_batch:
+            on_batch(entry, chunk)
+
+    last_submit = 0.0
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        running: Dict[Any, Tuple[int, List[Dict]]] = {}
+        while True:
+            while len(running) < max_in_flight:
+                nxt = next_chunk()
+                if nxt is None:
+                    break
+                if min_interval:
+                    time.sleep(max(0.0, last_submit + min_interval - time.monotonic()))
+                last_submit = time.monotonic()
+                running[pool.submit(send_with_retry, send, nxt[1], max_retries, backoff)] = nxt
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                start, chunk = running.pop(fut)
+                entry = {"start": start, "count": len(chunk)}
+                try:
+                    resp, elapsed, retries = fut.result()
+                except PayloadTooLargeError as e:
+                    if len(chunk) > 1:
+                        half = len(chunk) // 2
+                        retry_queue.extend([(start, chunk[:half]), (start + half, chunk[half:])])
+                        size = max(min_batch_size, half)
+                        continue
+                    finish(dict(entry, ok=False, error=str(e)), chunk)
+                    continue
+                except Exception as e:
+                    finish(dict(entry, ok=False, error=str(e)), chunk)
+                    continue
+                failed = edit_result_failures(resp)
+                results["total"] += len(chunk)
+                results["failed_features"] += failed
+                finish(dict(entry, ok=True, failed=failed, retries=retries,
+                            seconds=round(elapsed, 3), response=resp), chunk)
+                if elapsed > target_seconds:
+                    size = max(min_batch_size, size // 2)
+                elif elapsed < target_seconds / 2 and len(chunk) >= size:
+                    size = min(max_batch_size, size * 2)
+    results["batches"].sort(key=lambda b: b["start"])
+    return results
+
+
+def batch_object_ids(resp: Any) -> List[Any]:
+    if not isinstance(resp, dict):
+        return []
+    return [r.get("objectId") for r in resp.get("addResults") or [] if r.get("success", True)]
+
 
-        results["batches"].append({"index": i // batch_size, "ok": True, "response": j})
-        time.sleep(sleep_between_batches)
+def failed_add_indexes(resp: Any) -> List[int]:
+    """Positions in the sent chunk of the addResults entries with success: false."""
+    if not isinstance(resp, dict):
+        return []
+    return [i for i, r in enumerate(resp.get("addResults") or []) if not r.get("success", True)]
 
+
+def acknowledged_ranges(start: int, count: int, failed: Iterable[int]) -> List[Tuple[int, int]]:
+    """(start, count) runs of [start, start + count) without the failed offsets."""
+    ranges = []
+    run_start = start
+    for offset in sorted(set(failed)) + [start + count]:
+        if offset > run_start:
+            ranges.append((run_start, offset - run_start))
+        run_start = offset + 1
+    return ranges
+
+
+def load_journal(path: str, fingerprint: Dict) -> List[Tuple[int, int]]:
+    """
+    (start, count) of the features acknowledged in a previous run of the same upload.
+    Features the service rejected (journaled as "failed") are left out, so --resume sends them again.
+    """
+    if not os.path.exists(path):
+        return []
+    ranges = []
+    with open(path, "r", encoding="utf-8") as fh:
+        for n, line in enumerate(fh):
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash: that batch was not confirmed
+                break
+            if n == 0:
+                if rec.get("fingerprint") != fingerprint:
+                    raise RuntimeError(f"Journal {path} belongs to a different upload: {rec.get('fingerprint')}")
+                continue
+            ranges.extend(acknowledged_ranges(rec["start"], rec["count"], rec.get("failed", [])))
+    return ranges
+
+
+def journal_writer(path: str, fingerprint: Dict, resume: bool = False) -> Callable[[Dict, List[Dict]], None]:
+    """
+    on_batch callback appending every acknowledged batch (offsets, returned objectIds and the
+    offsets of features rejected in addResults) to path. Without resume the journal is started over.
+    """
+    if not resume or not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+
+    def write(entry: Dict, chunk: List[Dict]) -> None:
+        if not entry["ok"]:
+            return
+        rec = {"start": entry["start"], "count": entry["count"], "object_ids": batch_object_ids(entry.get("response"))}
+        failed = failed_add_indexes(entry.get("response"))
+        if failed:
+            rec["failed"] = [entry["start"] + i for i in failed]
+        with open(path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(rec) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    return write
+
+
+def apply_edits(session: requests.Session, feature_layer_url: str, adds: Optional[List[Dict]] = None,
+                deletes: Optional[List[Any]] = None, token: Optional[str] = None, timeout: int = 60) -> Dict:
+    url = feature_layer_url.rstrip("/") + "/applyEdits"
+    payload = {}
+    if adds:
+        payload["adds"] = json.dumps(adds, ensure_ascii=False)
+    if deletes:
+        payload["deletes"] = ",".join(str(oid) for oid in deletes)
+    return post_form(session, url, payload, token, timeout)
+
+
+def object_id_field(session: requests.Session, feature_layer_url: str, token: Optional[str] = None,
+                    timeout: int = 60) -> str:
+    """Name of the layer's objectId field, from the layer description."""
+    j = post_form(session, feature_layer_url.rstrip("/"), {}, token, timeout)
+    if j.get("objectIdField"):
+        return j["objectIdField"]
+    for field in j.get("fields") or []:
+        if field.get("type") == "esriFieldTypeOID":
+            return field["name"]
+    return "OBJECTID"
+
+
+def query_feature_hashes(session: requests.Session, feature_layer_url: str, hash_field: str,
+                         token: Optional[str] = None, page_size: int = 2000, timeout: int = 60) -> Dict[Any, List[Any]]:
+    """{hash: [objectId, ...]} for every feature in the layer, fetched page by page without geometry."""
+    url = feature_layer_url.rstrip("/") + "/query"
+    existing: Dict[Any, List[Any]] = {}
+    oid_field = object_id_field(session, feature_layer_url, token, timeout)
+    offset = 0
+    while True:
+        # resultOffset paging is only stable with an explicit order
+        j = post_form(session, url, {
+            "where": "1=1",
+            "outFields": f"{oid_field},{hash_field}",
+            "orderByFields": oid_field,
+            "returnGeometry": "false",
+            "resultOffset": offset,
+            "resultRecordCount": page_size,
+        }, token, timeout)
+        oid_field = j.get("objectIdFieldName") or oid_field
+        feats = j.get("features") or []
+        for f in feats:
+            a = f.get("attributes") or {}
+            oid = a.get(oid_field, a.get(oid_field.lower()))
+            existing.setdefault(a.get(hash_field), []).append(oid)
+        offset += len(feats)
+        if not feats or not j.get("exceededTransferLimit"):
+            return existing
+
+
+def feature_hash(feature: Dict, seen: Counter, hash_field: str) -> str:
+    """
+    sha1 of attributes + geometry plus an occurrence number (identical features get distinct hashes).
+    A hash the transform already put in attributes[hash_field] is kept.
+    """
+    attrs = feature.get("attributes") or {}
+    if attrs.get(hash_field):
+        return attrs[hash_field]
+    content = json.dumps([sorted((k, v) for k, v in attrs.items() if k != hash_field), feature.get("geometry")],
+                         ensure_ascii=False, default=str)
+    base = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    n = seen[base]
+    seen[base] += 1
+    return hashlib.sha1(f"{base}:{n}".encode("ascii")).hexdigest()
+
+
+def sync_features(
+    send_adds: Callable[[List[Dict]], Any],
+    send_deletes: Callable[[List[Any]], Any],
+    features: Iterable[Dict],
+    existing: Dict[Any, List[Any]],
+    hash_field: str = "row_hash",
+    **kwargs,
+) -> Dict:
+    """
+    Make a layer match features by content hash: features whose hash is not in existing
+    ({hash: [objectIds]}) are added, objectIds whose hash is no longer present (or extra
+    copies of one hash) are deleted. Deletes only run when every add succeeded, so a failed
+    sync never leaves the layer with less data; rerunning it converges.
+    """
+    keep = set()
+    seen: Counter = Counter()
+
+    def new_features():
+        for f in features:
+            h = feature_hash(f, seen, hash_field)
+            if h in existing:
+                keep.add(h)
+                continue
+            attrs = dict(f.get("attributes") or {}, **{hash_field: h})
+            yield dict(f, attributes=attrs)
+
+    results: Dict[str, Any] = {"adds": upload_concurrently(send_adds, new_features(), **kwargs)}
+    stale = [oid for h, oids in existing.items() for oid in (oids if h not in keep else oids[1:])]
+    results["unchanged"] = len(keep)
+    results["to_delete"] = len(stale)
+    if results["adds"]["success"] and stale:
+        results["deletes"] = upload_concurrently(send_deletes, stale, **kwargs)
+    results["success"] = results["adds"]["success"] and results.get("deletes", {"success": True})["success"]
     return results
+
+
+def sync_features_via_rest(
+    features: Iterable[Dict],
+    feature_layer_url: str,
+    token: Optional[str] = None,
+    hash_field: str = "row_hash",
+    timeout: int = 60,
+    max_in_flight: int = 4,
+    session: Optional[requests.Session] = None,
+    **kwargs,
+) -> Dict:
+    """query the layer's hashes once, then applyEdits only the differences."""
+    own_session = session is None
+    session = session or make_session(max_in_flight)
+    try:
+        existing = query_feature_hashes(session, feature_layer_url, hash_field, token, timeout=timeout)
+        return sync_features(
+            lambda chunk: apply_edits(session, feature_layer_url, adds=chunk, token=token, timeout=timeout),
+            lambda oids: apply_edits(session, feature_layer_url, deletes=oids, token=token, timeout=timeout),
+            features,
+            existing,
+            hash_field=hash_field,
+            max_in_flight=max_in_flight,
+            **kwargs,
+        )
+    finally:
+        if own_session:
+            session.close()
+
+
+def upload_features_via_rest(
+    features: Iterable[Dict],
+    feature_layer_url: str,
+    token: Optional[str] = None,
+    batch_size: int = 200,
+    sleep_between_batches: float = 0.0,
+    timeout: int = 60,
+    max_in_flight: int = 4,
+    max_batch_size: int = 2000,
+    max_retries: int = 5,
+    session: Optional[requests.Session] = None,
+    **kwargs,
+) -> Dict:
+    """addFeatures over one pooled session; see upload_concurrently for the batching rules."""
+    own_session = session is None
+    session = session or make_session(max_in_flight)
+    try:
+        return upload_concurrently(
+            lambda chunk: add_features(session, feature_layer_url, chunk, token, timeout),
+            features,
+            batch_size=batch_size,
+            max_batch_size=max_batch_size,
+            max_in_flight=max_in_flight,
+            max_retries=max_retries,
+            min_interval=sleep_between_batches,
+            **kwargs,
+        )
+    finally:
+        if own_session:
+            session.close()
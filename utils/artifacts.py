@@ -0,0 +1,133 @@
+"""
+Columnar features artifact (Parquet or Arrow IPC) written by transform_to_postgis and read
+back in record batches by the DB loader and upload_to_arcgis.
+"""
+
+from typing import Dict, Iterable, Iterator, List
+
+from utils.fields import VALUE_FIELDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+    ipc = None
+    pq = None
+
+ARTIFACT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+TEXT_FIELDS = ["d_date", "t_region", "t_city"]
+COORD_FIELDS = ["long", "lat"]
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for parquet/arrow artifacts (install pyarrow).")
+
+
+def is_artifact(path: str) -> bool:
+    return any(path.endswith(ext) for ext in ARTIFACT_FORMATS.values())
+
+
+def artifact_schema(mode: str = "expanded"):
+    require_pyarrow()
+    # expanded mode only has 0/1 flags; weighted mode keeps per-row counts
+    value_type = pa.int8() if mode == "expanded" else pa.int32()
+    return pa.schema(
+        [(c, pa.string()) for c in TEXT_FIELDS]
+        + [(c, pa.float64()) for c in COORD_FIELDS]
+        + [(c, value_type) for c in VALUE_FIELDS]
+        + [("row_hash", pa.string())],
+        metadata={"mode": mode},
+    )
+
+
+def read_artifact_schema(path: str):
+    require_pyarrow()
+    if path.endswith(ARTIFACT_FORMATS["parquet"]):
+        return pq.read_schema(path)
+    with pa.memory_map(path, "r") as source:
+        return ipc.open_file(source).schema
+
+
+def artifact_mode(path: str) -> str:
+    """--mode the artifact was written with: schema metadata, else the value type (int8 flags / int32 counts)."""
+    schema = read_artifact_schema(path)
+    mode = (schema.metadata or {}).get(b"mode")
+    if mode:
+        return mode.decode("utf-8")
+    return "expanded" if schema.field(VALUE_FIELDS[0]).type == pa.int8() else "weighted"
+
+
+def features_to_batch(features: List[Dict], schema):
+    attrs = [f["attributes"] for f in features]
+    arrays = [
+        pa.array([a.get(field.name) for a in attrs], type=field.type, from_pandas=True)
+        for field in schema
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ArtifactWriter:
+    """Append feature chunks to one Parquet / Arrow IPC file; use as a context manager."""
+
+    def __init__(self, path: str, fmt: str, mode: str = "expanded"):
+        self.schema = artifact_schema(mode)
+        self.count = 0
+        if fmt == "parquet":
+            self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self._sink = pa.OSFile(path, "wb")
+            self._writer = ipc.new_file(self._sink, self.schema)
+
+    def write(self, features: List[Dict]) -> int:
+        if features:
+            batch = features_to_batch(features, self.schema)
+            if isinstance(self._writer, pq.ParquetWriter):
+                self._writer.write_batch(batch)
+            else:
+                self._writer.write(batch)
+            self.count += len(features)
+        return len(features)
+
+    def close(self):
+        self._writer.close()
+        if hasattr(self, "_sink"):
+            self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_artifact(path: str, fmt: str, features: Iterable[Dict], mode: str = "expanded") -> int:
+    with ArtifactWriter(path, fmt, mode) as w:
+        w.write(list(features))
+    return w.count
+
+
+def iter_record_batches(path: str, batch_size: int = 10000):
+    require_pyarrow()
+    if path.endswith(ARTIFACT_FORMATS["parquet"]):
+        yield from pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size)
+        return
+    with pa.memory_map(path, "r") as source:
+        reader = ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def iter_artifact_features(path: str, batch_size: int = 10000) -> Iterator[Dict]:
+    """Features ({"attributes", "wkt"}) from a memory-mapped artifact, one record batch at a time."""
+    for batch in iter_record_batches(path, batch_size):
+        columns = batch.to_pydict()
+        hashes = columns.pop("row_hash", None) or [None] * batch.num_rows
+        names = list(columns)
+        for values, h in zip(zip(*columns.values()), hashes):
+            attrs = dict(zip(names, values))
+            if h is not None:
+                attrs["row_hash"] = h
+            yield {"attributes": attrs, "wkt": f"POINT({attrs['long']} {attrs['lat']})"}
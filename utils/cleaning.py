@@ -0,0 +1,155 @@
+"""
+Column-level cleaning shared by fetch_gs, transform_to_postgis and upload_to_arcgis:
+numbers with decimal commas / thousand separators, coordinates, and sheet dates.
+"""
+
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# tried in order on the distinct values of a column; the best match is used for the whole column
+DATE_FORMATS = ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y/%m/%d", "%d-%m-%Y", "%d.%m.%y"]
+COORDINATE_RANGES = {"lon": (-180.0, 180.0), "lat": (-90.0, 90.0)}
+
+
+def normalize_number_str(s):
+    if s is None:
+        return None
+    if isinstance(s, (int, float)):
+        return s
+    s = str(s).strip()
+    if s == "":
+        return None
+    s = s.replace("\u00A0", "")
+    s = s.replace(" ", "")
+    s = s.replace("'", "").replace("’", "").replace("`", "")
+    s = s.replace(",", ".")
+    try:
+        if re.search(r"[.eE]", s):
+            return float(s)
+        return int(s)
+    except Exception:
+        try:
+            return float(s)
+        except Exception:
+            return None
+
+
+def parse_number_column(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Columnar normalize_number_str: returns (float values, parsed mask).
+    # The fast path only accepts what pd.to_numeric understands; every other
+    # non-empty cell goes through normalize_number_str so results stay identical.
+    cleaned = (
+        pd.Series(values, dtype=object).astype(str)
+        .str.strip()
+        .str.replace(r"[\u00A0 '’`]", "", regex=True)
+        .str.replace(",", ".", regex=False)
+    )
+    nums = pd.to_numeric(cleaned, errors="coerce").to_numpy(dtype=float)
+    ok = ~np.isnan(nums)
+    for i in np.flatnonzero(~ok):
+        num = normalize_number_str(values[i])
+        if num is None:
+            continue
+        try:
+            nums[i] = float(num)
+            ok[i] = True
+        except Exception:
+            continue
+    return nums, ok
+
+
+def parse_coordinate_column(values: np.ndarray, axis: str) -> Tuple[np.ndarray, np.ndarray]:
+    """parse_number_column plus a range check: axis is "lon" or "lat"."""
+    lo, hi = COORDINATE_RANGES[axis]
+    nums, ok = parse_number_column(values)
+    with np.errstate(invalid="ignore"):
+        ok &= (nums >= lo) & (nums <= hi)
+    return nums, ok
+
+
+def clean_number_series(s: pd.Series) -> pd.Series:
+    nums, ok = parse_number_column(s.to_numpy(dtype=object))
+    return pd.Series(np.where(ok, nums, np.nan), index=s.index)
+
+
+def clean_coordinate_series(s: pd.Series, axis: str) -> pd.Series:
+    nums, ok = parse_coordinate_column(s.to_numpy(dtype=object), axis)
+    return pd.Series(np.where(ok, nums, np.nan), index=s.index)
+
+
+def sheet_values_to_df(values: List[List[str]]) -> pd.DataFrame:
+    """
+    Sheet rows (header first, as from get_all_values) as read_csv(dtype=str) would read their
+    CSV export: stripped column names and empty cells as NaN, so both paths load the same rows.
+    """
+    df = pd.DataFrame(values[1:], columns=values[0])
+    df.columns = [str(c).strip() for c in df.columns]
+    return df.replace("", np.nan)
+
+
+def parse_date_value(d_raw):
+    if d_raw is None or str(d_raw).strip() == "":
+        return None
+    try:
+        # year-first strings are never day-first: dayfirst would swap 2024-03-05 into May
+        d_date = pd.to_datetime(d_raw, format="%Y-%m-%d", errors='coerce')
+        if pd.isna(d_date):
+            d_date = pd.to_datetime(d_raw, dayfirst=True, errors='coerce')
+        if pd.isna(d_date):
+            return str(d_raw)
+        return d_date.strftime("%Y-%m-%d")
+    except Exception:
+        return str(d_raw)
+
+
+def detect_date_format(uniques: pd.Series) -> Optional[str]:
+    best, best_n = None, 0
+    for fmt in DATE_FORMATS:
+        n = int(pd.to_datetime(uniques, format=fmt, errors="coerce").notna().sum())
+        if n > best_n:
+            best, best_n = fmt, n
+            if n == len(uniques):
+                break
+    return best
+
+
+def parse_date_column(values: np.ndarray) -> np.ndarray:
+    """
+    Dates as "YYYY-MM-DD" strings (None for blanks, the raw string when unparseable).
+    The format is detected once on the distinct values; only values that do not match it
+    go through the per-value dayfirst parser.
+    """
+    raw = pd.Series(values, dtype=object)
+    blank = raw.isna() | (raw.astype(str).str.strip() == "")
+    text = raw.astype(str).str.strip()
+    uniques = pd.Series(text[~blank].unique(), dtype=object)
+    parsed = {}
+    if len(uniques):
+        fmt = detect_date_format(uniques)
+        dates = pd.to_datetime(uniques, format=fmt, errors="coerce") if fmt else pd.Series(pd.NaT, index=uniques.index)
+        for u, d in zip(uniques.tolist(), dates.tolist()):
+            parsed[u] = d.strftime("%Y-%m-%d") if not pd.isna(d) else None
+    out = np.empty(len(raw), dtype=object)
+    fallback = {}
+    for i, (v, t, b) in enumerate(zip(values, text.tolist(), blank.tolist())):
+        if b:
+            out[i] = None
+        elif parsed.get(t) is not None:
+            out[i] = parsed[t]
+        else:
+            if t not in fallback:
+                fallback[t] = parse_date_value(v)
+            out[i] = fallback[t]
+    return out
+
+
+def date_to_epoch_ms(iso: Optional[str]) -> Optional[int]:
+    # naive local midnight, as ArcGIS date fields were filled before
+    try:
+        return int(datetime.strptime(iso, "%Y-%m-%d").timestamp() * 1000)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,60 @@
+"""
+Per-table data version, bumped by the loaders and read by the API to invalidate caches.
+"""
+
+from psycopg2 import sql
+
+VERSION_TABLE = "table_transformer_versions"
+# plain SQL (no psycopg2.sql composition) so the async API driver can run it too
+VERSION_TABLE_EXISTS_SQL = f"SELECT to_regclass('{VERSION_TABLE}') IS NOT NULL"
+SELECT_VERSION_SQL = f"SELECT version FROM {VERSION_TABLE} WHERE table_name = %s"
+# a view (e.g. {table}_points of a weighted table) is versioned by the table it reads
+BASE_TABLE_SQL = (
+    "SELECT COALESCE((SELECT table_name FROM information_schema.view_table_usage "
+    "WHERE view_schema = current_schema() AND view_name = %s LIMIT 1), %s)"
+)
+
+
+def ensure_version_table(cur) -> None:
+    cur.execute(sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {vt} (
+      table_name TEXT PRIMARY KEY,
+      version BIGINT NOT NULL DEFAULT 0,
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """).format(vt=sql.Identifier(VERSION_TABLE)))
+
+
+def bump_data_version(cur, table_name: str) -> int:
+    """Increment the version of table_name inside the caller's transaction."""
+    ensure_version_table(cur)
+    cur.execute(sql.SQL("""
+    INSERT INTO {vt} AS v (table_name, version) VALUES (%s, 1)
+    ON CONFLICT (table_name) DO UPDATE SET version = v.version + 1, updated_at = now()
+    RETURNING version;
+    """).format(vt=sql.Identifier(VERSION_TABLE)), (table_name,))
+    return cur.fetchone()[0]
+
+
+def get_data_version(cur, table_name: str) -> int:
+    """Current version of table_name (or of the table a view reads); 0 if it was never bumped."""
+    cur.execute(VERSION_TABLE_EXISTS_SQL)
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute(BASE_TABLE_SQL, (table_name, table_name))
+    table_name = cur.fetchone()[0]
+    cur.execute(SELECT_VERSION_SQL, (table_name,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+async def get_data_version_async(cur, table_name: str) -> int:
+    """get_data_version for an async (psycopg 3) cursor; table_name may be a view over the table."""
+    await cur.execute(VERSION_TABLE_EXISTS_SQL)
+    if not (await cur.fetchone())[0]:
+        return 0
+    await cur.execute(BASE_TABLE_SQL, (table_name, table_name), prepare=True)
+    table_name = (await cur.fetchone())[0]
+    await cur.execute(SELECT_VERSION_SQL, (table_name,), prepare=True)
+    row = await cur.fetchone()
+    return row[0] if row else 0
@@ -0,0 +1,5 @@
+"""
+Column names of the features table shared by the loaders, the artifacts, the stats table and the API.
+"""
+
+VALUE_FIELDS = [f"i_value_{k}" for k in range(1, 11)]
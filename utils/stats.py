@@ -0,0 +1,60 @@
+"""
+Summary table {table}_daily_stats at d_date / t_region / t_city grain, rebuilt by the loaders
+in the same transaction as the data change and read by the API /stats endpoint.
+"""
+
+from psycopg2 import sql
+
+from utils.fields import VALUE_FIELDS
+
+STATS_SUFFIX = "_daily_stats"
+
+
+def stats_table_name(table_name: str) -> str:
+    return f"{table_name}{STATS_SUFFIX}"
+
+
+def ensure_stats_table(cur, table_name: str) -> None:
+    stats = stats_table_name(table_name)
+    cur.execute(sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {stats} (
+      d_date DATE,
+      t_region TEXT,
+      t_city TEXT,
+      features BIGINT NOT NULL,
+      {values}
+    );
+    """).format(
+        stats=sql.Identifier(stats),
+        values=sql.SQL(", ").join(sql.SQL("{c} BIGINT NOT NULL").format(c=sql.Identifier(c)) for c in VALUE_FIELDS),
+    ))
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {idx} ON {stats} (d_date);").format(
+        idx=sql.Identifier(f"{stats}_d_date_idx"), stats=sql.Identifier(stats)))
+
+
+def refresh_stats(cur, table_name: str) -> int:
+    """
+    Rebuild the summary of table_name inside the caller's transaction, so readers switch
+    from the old to the new counts at commit together with the data. Returns its row count.
+    features counts points: a weighted row (n_points) stands for n_points expanded rows.
+    """
+    ensure_stats_table(cur, table_name)
+    stats = sql.Identifier(stats_table_name(table_name))
+    cur.execute(
+        "SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'n_points' AND NOT attisdropped",
+        (sql.Identifier(table_name).as_string(cur),),
+    )
+    features = sql.SQL("COALESCE(SUM(n_points), 0)") if cur.fetchone() else sql.SQL("COUNT(*)")
+    cur.execute(sql.SQL("DELETE FROM {stats};").format(stats=stats))
+    cur.execute(sql.SQL("""
+    INSERT INTO {stats} (d_date, t_region, t_city, features, {cols})
+    SELECT d_date, t_region, t_city, {features}, {sums}
+    FROM {tbl} GROUP BY d_date, t_region, t_city;
+    """).format(
+        stats=stats,
+        features=features,
+        tbl=sql.Identifier(table_name),
+        cols=sql.SQL(", ").join(sql.Identifier(c) for c in VALUE_FIELDS),
+        sums=sql.SQL(", ").join(sql.SQL("COALESCE(SUM({c}), 0)").format(c=sql.Identifier(c)) for c in VALUE_FIELDS),
+    ))
+    return cur.rowcount